@@ -4,16 +4,27 @@ api.py also contains the hangman game logic. For more complex games it would be
 move game logic to another file. Ideally the API will be simple, concerned
 primarily with communication to/from the API's users."""
 
+import collections
+import logging
+from datetime import date, datetime, timedelta
+
 import endpoints
 from protorpc import remote, messages
-from google.appengine.api import memcache
-from google.appengine.api import taskqueue
+from google.appengine.api import datastore_errors
+
+from google.appengine.ext import ndb
 
-from models import User, Game, Score
+from models import User, Game, Score, UserRanking, PeriodRanking,\
+    AttemptsRemainingShard, MovedGame, GameArchive, LEGACY_USER_LOOKUP
 from models import StringMessage, NewGameForm, GameForm, GuessForm,\
     ScoreForms, ScoreForm, GameForms, UserForm, UserForms, HighScoresForm,\
-    HistoryForms, History
-from utils import get_by_urlsafe
+    HistoryForms, History, PageForm, NewGamesForm, GuessesForm,\
+    BatchResultForm, BatchResultForms
+from cache import GameCache, HighScoreCache, ResponseCache
+from metrics import instrumented
+from words import ALPHABET, DIFFICULTIES, letter_bit, is_solved
+from utils import get_key_by_urlsafe, get_user_names, fetch_page,\
+    fetch_page_async, rate_limited
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
@@ -22,8 +33,42 @@ GUESS_REQUEST = endpoints.ResourceContainer(
     GuessForm, urlsafe_game_key=messages.StringField(1))
 USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1),
                                            email=messages.StringField(2))
+PAGE_REQUEST = endpoints.ResourceContainer(PageForm)
+USER_PAGE_REQUEST = endpoints.ResourceContainer(
+    PageForm, user_name=messages.StringField(3))
+GAME_PAGE_REQUEST = endpoints.ResourceContainer(
+    PageForm, urlsafe_game_key=messages.StringField(3))
+PERIOD_RANKING_REQUEST = endpoints.ResourceContainer(
+    PageForm, window=messages.StringField(3, required=True),
+    date=messages.StringField(4))
 
 MEMCACHE_GUESSES_REMAINING = 'GUESSES_REMAINING'
+GUESSES_REMAINING_TIME = 10
+# How long the first page of the user rankings is served from memcache
+RANKINGS_TIME = 10
+REBUILD_BATCH_SIZE = 500
+MAX_BATCH_SIZE = 100
+# A transaction may span 25 entity groups, and the attempts counter takes
+# one. A game that ends in a batch of guesses touches its user's group, which
+# holds the game, its Score and the rankings; a game stored before games
+# were children of their user also touches its own group.
+GUESS_TRANSACTION_GROUPS = 24
+ALL_TIME = 'all_time'
+# Batches of expired rankings deleted per request before handing the rest
+# to a continuation task
+EXPIRE_BATCHES = 20
+# Finished games are moved to the archive this long after they ended
+ARCHIVE_AFTER = timedelta(days=30)
+# Games archived per batch, and batches per request before handing the rest
+# to a continuation task
+ARCHIVE_BATCH_SIZE = 100
+ARCHIVE_BATCHES = 10
+# Legacy users rekeyed per migration task
+MIGRATE_BATCH_SIZE = 20
+# Games moved under their user per transaction. Each touches its old group,
+# its user's and the group of the MovedGame left behind, within the 25
+# entity groups a transaction may span.
+MIGRATE_TRANSACTION_GAMES = 8
 
 
 @endpoints.api(name='hangman', version='v1')
@@ -34,30 +79,47 @@ class HangmanApi(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @instrumented
     def create_user(self, request):
         """Create a User. Requires a unique username"""
-        if User.query(User.name == request.user_name).get():
+        if not request.user_name or not User.normalize(request.user_name):
+            raise endpoints.BadRequestException('A user name is required!')
+        if LEGACY_USER_LOOKUP and User.get_by_name(request.user_name):
             raise endpoints.ConflictException(
                 'A User with that name already exists!')
-        user = User(name=request.user_name, email=request.email)
-        user.put()
+        self._create_user(request.user_name, request.email)
         return StringMessage(message='User {} created!'.format(
             request.user_name))
 
+    @staticmethod
+    @ndb.transactional
+    def _create_user(name, email):
+        """Stores a new User and its empty ranking. The transaction makes
+        the name check and the put atomic, so names stay unique."""
+        key = User.key_for(name)
+        if key.get():
+            raise endpoints.ConflictException(
+                'A User with that name already exists!')
+        ndb.put_multi([User(key=key, name=name, email=email),
+                       UserRanking(key=UserRanking.key_for(key),
+                                   user_name=name)])
+
     @endpoints.method(request_message=NEW_GAME_REQUEST,
                       response_message=GameForm,
                       path="game",
                       name="new_game",
                       http_method="POST")
+    @instrumented
     def new_game(self, request):
-        """Creates new game"""
-        user = User.query(User.name == request.user_name).get()
+        """Creates new game, with a word of the requested difficulty if
+        any"""
+        self._check_difficulty(request.difficulty)
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                 'A user with that name does not exist!')
-        game = Game.new_game(user.key)
-        # Task queue updates average attempts remaining.
-        taskqueue.add(url='/tasks/cache_attempts')
+        game = Game.new_game(user.key, user.name, request.difficulty or None)
+        GameCache.set(game)
         return game.to_form("A New Hangman Game Has Been Created!")
 
     @endpoints.method(request_message=GUESS_REQUEST,
@@ -65,125 +127,378 @@ class HangmanApi(remote.Service):
                       path="game/{urlsafe_game_key}/letter",
                       name="make_guess",
                       http_method="PUT")
+    @instrumented
     def make_guess(self, request):
         """Makes a move. Returns a game state with message"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game:
-            if game.game_over:
-                return game.to_form("Game is already over!")
-            if not request.guess:
-                return game.to_form("Please guess a letter.")
-            if request.guess.lower() in game.past_guesses:
-                return game.to_form("You already guessed that letter!")
-            if len(request.guess) != 1:
-                return game.to_form("You can only guess a single letter.")
-            if not request.guess.isalpha():
-                return game.to_form("You should guess a letter from the alphabet!")
-            # Assess the guessed letter
-            game.past_guesses.append(request.guess.lower())
-            move_number = len(game.past_guesses)
-            if request.guess.lower() in game.target_word.lower():
-                guess_instances = [i for i, ltr in enumerate(
-                    game.target_word.lower()) if ltr == request.guess.lower()]
-                for i in guess_instances:
-                    game.word_state = game.word_state[
-                        :i] + game.target_word[i] + game.word_state[i + 1:]
-                if game.word_state == game.target_word:
-                    # 1 point for guessing final letter
-                    message = "You won! Score is {}. The word is {}.".format(
-                    game.attempts_remaining , game.target_word)
-                    game.save_history(request.guess, message, move_number)
-                    game.end_game(True, game.attempts_remaining)
-                    return game.to_form(message)
-                else:
-                    message = "Correct guess! Word so far: " + game.word_state
-                    game.save_history(request.guess, message, move_number)
-                    game.put()
-                    return game.to_form(message)
+        game_key = self._game_key(request.urlsafe_game_key)
+        game, message = self._make_guess(game_key, request.guess)
+        GameCache.set(game)
+        return game.to_form(message)
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _make_guess(game_key, guess):
+        """Applies a guess to the game and stores the new state together with
+        the move in a single put. Runs in a transaction so concurrent guesses
+        on one game are applied one after the other. The attempts counter is
+        updated while the game is put.
+        Returns the game and the message for the player."""
+        game = game_key.get()
+        if not game:
+            raise endpoints.NotFoundException("Game not found!")
+        attempts_before = game.attempts_remaining
+        history_keys = game.fold_legacy_history()
+        message, changed, ending = HangmanApi._apply_guess(game, guess)
+        delta = HangmanApi._attempts_delta(game, attempts_before)
+        counter = AttemptsRemainingShard.add_async(delta) if delta else None
+        if changed and history_keys:
+            ndb.delete_multi(history_keys)
+        if ending:
+            game.end_game(*ending)
+        elif changed:
+            game.put()
+        if counter:
+            counter.get_result()
+        return game, message
+
+    @staticmethod
+    def _apply_guess(game, guess):
+        """Applies a guess to a game in memory. Returns the message for the
+        player, whether the game changed, and a (won, points) tuple if the
+        guess ended the game or None. A game that ends is marked game_over
+        but its Score is left to Game.end_game or Game.finish_games."""
+        if game.game_over:
+            return "Game is already over!", False, None
+        if not guess:
+            return "Please guess a letter.", False, None
+        if len(guess) != 1:
+            return "You can only guess a single letter.", False, None
+        if not guess.isalpha() or guess.lower() not in ALPHABET:
+            return ("You should guess a letter from the alphabet!", False,
+                    None)
+        if game.has_guessed(guess.lower()):
+            return "You already guessed that letter!", False, None
+        # Assess the guessed letter
+        game.add_guess(guess.lower())
+        ending = None
+        word_mask = game.target_mask
+        if word_mask & letter_bit(guess.lower()):
+            if is_solved(word_mask, game.guessed):
+                # 1 point for guessing final letter
+                message = "You won! Score is {}. The word is {}.".format(
+                game.attempts_remaining , game.target_word)
+                ending = (True, game.attempts_remaining)
+            else:
+                message = "Correct guess! Word so far: " + game.word_state
+        else:
+            game.attempts_remaining -= 1
+            if game.attempts_remaining < 1:
+                # 0 points for loss
+                message = "Game over! Score is 0. Correct word is: " + game.target_word
+                ending = (False, game.attempts_remaining)
+            else:
+                message = "Incorrect guess! Word so far: " + game.word_state
+        game.save_history(guess, message)
+        if ending:
+            game.game_over = True
+        return message, True, ending
+
+    @staticmethod
+    def _attempts_delta(game, attempts_before):
+        """Returns the change in the attempts remaining counter for a game
+        that had attempts_before. Finished games no longer count."""
+        attempts_after = 0 if game.game_over else game.attempts_remaining
+        return attempts_after - attempts_before
+
+    @endpoints.method(request_message=NewGamesForm,
+                      response_message=BatchResultForms,
+                      path="games",
+                      name="new_games",
+                      http_method="POST")
+    @instrumented
+    def new_games(self, request):
+        """Creates games_per_user new games for each of the users, with one
+        transaction per user that puts its games, its seen words and their
+        attempts together. Returns the games, or an error for each user that
+        does not exist or whose games could not be saved."""
+        if not 0 < request.games_per_user * len(request.user_names) <= \
+                MAX_BATCH_SIZE:
+            raise endpoints.BadRequestException(
+                'Between 1 and {} games can be created at once'.format(
+                    MAX_BATCH_SIZE))
+        self._check_difficulty(request.difficulty)
+        users = User.get_by_names(request.user_names)
+        # Names of the same user, such as 'Bob' and 'bob', get its games once
+        distinct = collections.OrderedDict()
+        for name in request.user_names:
+            if users[name]:
+                distinct.setdefault(users[name].key, (name, users[name]))
+        # Each user's games are created in a transaction of their own. The
+        # transactions run concurrently, as many at a time as there are
+        # counter shards so that no two of them add to the same shard.
+        games_by_user = {}
+        users_left = distinct.values()
+        while users_left:
+            wave = users_left[:AttemptsRemainingShard.NUM_SHARDS]
+            users_left = users_left[AttemptsRemainingShard.NUM_SHARDS:]
+            shards = AttemptsRemainingShard.shard_ids(len(wave))
+            futures = [Game.new_games_async(user.key, user.name,
+                                            request.games_per_user,
+                                            request.difficulty or None, shard)
+                       for (_, user), shard in zip(wave, shards)]
+            for (_, user), future in zip(wave, futures):
+                try:
+                    games_by_user[user.key] = future.get_result()
+                except datastore_errors.Error:
+                    logging.exception('Games of %s failed', user.name)
+                    games_by_user[user.key] = None
+        results = []
+        for name in request.user_names:
+            user = users[name]
+            if not user:
+                results.append(BatchResultForm(
+                    item=name, error='A user with that name does not exist!'))
+                continue
+            first_name = distinct[user.key][0]
+            if first_name != name or user.key not in games_by_user:
+                results.append(BatchResultForm(
+                    item=name, error='Games were already created for this '
+                    'user as {}'.format(first_name)))
+                continue
+            games = games_by_user.pop(user.key)
+            if games is None:
+                results.append(BatchResultForm(
+                    item=name, error='Could not save, please retry.'))
+                continue
+            for game in games:
+                results.append(BatchResultForm(
+                    item=name, game=game.to_form(
+                        "A New Hangman Game Has Been Created!")))
+        return BatchResultForms(items=results)
+
+    @endpoints.method(request_message=GuessesForm,
+                      response_message=BatchResultForms,
+                      path="games/letters",
+                      name="make_guesses",
+                      http_method="PUT")
+    @instrumented
+    def make_guesses(self, request):
+        """Makes a move in each of several games. Games are read with
+        batched gets and written with batched puts, in concurrent
+        transactions of up to GUESS_TRANSACTION_GROUPS entity groups, see
+        _guess_waves. Returns the state of each game after the batch, with
+        the message for each guess, or an error."""
+        if not 0 < len(request.items) <= MAX_BATCH_SIZE:
+            raise endpoints.BadRequestException(
+                'Between 1 and {} guesses can be made at once'.format(
+                    MAX_BATCH_SIZE))
+        results = [None] * len(request.items)
+        guesses = collections.OrderedDict()
+        for i, item in enumerate(request.items):
+            try:
+                game_key = self._game_key(item.urlsafe_game_key)
+            except endpoints.BadRequestException as e:
+                results[i] = BatchResultForm(item=item.urlsafe_game_key,
+                                             error=e.message)
+                continue
+            guesses.setdefault(game_key, []).append((i, item.guess))
+        outcomes = []
+        for chunks in self._guess_waves(guesses):
+            shards = AttemptsRemainingShard.shard_ids(len(chunks))
+            futures = [self._make_guesses_async(chunk, shard)
+                       for chunk, shard in zip(chunks, shards)]
+            for chunk, future in zip(chunks, futures):
+                try:
+                    outcomes.extend(future.get_result())
+                except datastore_errors.Error:
+                    logging.exception('Batch of guesses failed')
+                    outcomes.extend((i, None, 'Could not save, please retry.')
+                                    for _, items in chunk for i, _ in items)
+        games = dict((game.key, game) for _, game, _ in outcomes if game)
+        names = get_user_names(game.user for game in games.values()
+                               if not game.user_name)
+        GameCache.set_multi(games.values())
+        for i, game, message in outcomes:
+            item = request.items[i].urlsafe_game_key
+            if game:
+                results[i] = BatchResultForm(item=item, game=game.to_form(
+                    message, names.get(game.user)))
             else:
-                game.attempts_remaining -= 1
-                if game.attempts_remaining < 1:
-                    # 0 points for loss
-                    message = "Game over! Score is 0. Correct word is: " + game.target_word
-                    game.save_history(request.guess, message, move_number)
-                    game.end_game(False, game.attempts_remaining)
-                    return game.to_form(message)
-                else:
-                    message = "Incorrect guess! Word so far: " + game.word_state
-                    game.save_history(request.guess, message, move_number)
-                    game.put()
-                    return game.to_form(message)
+                results[i] = BatchResultForm(item=item, error=message)
+        return BatchResultForms(items=results)
+
+    @staticmethod
+    def _guess_waves(guesses):
+        """Splits guesses, an ordered dict of game key to [(index, guess)],
+        into waves of chunks of (game key, [(index, guess)]) pairs. The
+        chunks of a wave run in concurrent transactions and the waves one
+        after another. A chunk spans at most GUESS_TRANSACTION_GROUPS entity
+        groups, and the games of a user are all in the same chunk of a wave,
+        so the concurrent transactions never contend for a user's group. Only
+        a user with more root-level games than fit in one chunk has them
+        spread over several waves."""
+        root_games = [game_key for game_key in guesses
+                      if not game_key.parent()]
+        root_games = dict(zip(root_games, ndb.get_multi(root_games)))
+        users = collections.OrderedDict()
+        for game_key, items in guesses.items():
+            if game_key.parent():
+                user_key, groups = game_key.parent(), set([game_key.parent()])
+            elif root_games[game_key]:
+                user_key = root_games[game_key].user
+                groups = set([game_key, user_key])
+            else:
+                user_key, groups = game_key, set([game_key])
+            users.setdefault(user_key, []).append(((game_key, items), groups))
+        waves = []
+        for games in users.values():
+            # The user's games, split in pieces that each fit in a chunk
+            pieces = [([], set())]
+            for game, groups in games:
+                if len(pieces[-1][1] | groups) > GUESS_TRANSACTION_GROUPS:
+                    pieces.append(([], set()))
+                pieces[-1][0].append(game)
+                pieces[-1][1].update(groups)
+            for wave, (piece, groups) in enumerate(pieces):
+                if wave == len(waves):
+                    waves.append([])
+                chunks = waves[wave]
+                # Users share no entity groups, so groups add up
+                if not chunks or len(chunks[-1][1]) + len(groups) > \
+                        GUESS_TRANSACTION_GROUPS:
+                    chunks.append(([], set()))
+                chunks[-1][0].extend(piece)
+                chunks[-1][1].update(groups)
+        return [[chunk for chunk, _ in chunks] for chunks in waves]
+
+    @staticmethod
+    @ndb.transactional_async(xg=True)
+    def _make_guesses_async(chunk, shard):
+        """Applies the guesses of a chunk, a list of (game key, [(index,
+        guess)]) pairs, with one batched get and one batched put, and adds
+        the change in attempts to the given counter shard. Returns an
+        (index, game, message) tuple per guess, with game None and an error
+        message if the game does not exist."""
+        games = ndb.get_multi([game_key for game_key, _ in chunk])
+        outcomes, endings, changed_games, history_keys = [], [], [], []
+        attempts_delta = 0
+        for (game_key, items), game in zip(chunk, games):
+            if not game:
+                outcomes.extend((i, None, "Game not found!") for i, _ in items)
+                continue
+            attempts_before = game.attempts_remaining
+            folded = game.fold_legacy_history()
+            game_changed = False
+            for i, guess in items:
+                message, changed, ending = HangmanApi._apply_guess(game, guess)
+                outcomes.append((i, game, message))
+                game_changed = game_changed or changed
+                if ending:
+                    endings.append((game,) + ending)
+            if game_changed:
+                history_keys.extend(folded)
+                if not game.game_over:
+                    changed_games.append(game)
+            attempts_delta += HangmanApi._attempts_delta(game, attempts_before)
+        entities = Game.finish_games(endings) + changed_games
+        futures = ndb.put_multi_async(entities)
+        futures.extend(ndb.delete_multi_async(history_keys))
+        if attempts_delta:
+            futures.append(AttemptsRemainingShard.add_async(attempts_delta,
+                                                            shard))
+        ndb.Future.wait_all(futures)
+        return outcomes
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameForm,
                       path="game/{urlsafe_game_key}",
                       name="get_game",
                       http_method="GET")
+    @instrumented
+    @rate_limited
     def get_game(self, request):
         """Return the current game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game_key = self._game_key(request.urlsafe_game_key)
+        game = GameCache.get(game_key) or GameArchive.get_game(game_key)
         if game:
             return game.to_form("Make a guess!")
         else:
             raise endpoints.NotFoundException("Game not found!")
 
-    @endpoints.method(response_message=ScoreForms,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @instrumented
     def get_scores(self, request):
-        """Return all scores (unordered)"""
-        return ScoreForms(items=[score.to_form() for score in Score.query()])
+        """Return a page of scores (unordered)"""
+        scores, next_cursor = fetch_page(Score.query(), request.page_size,
+                                         request.cursor)
+        names = get_user_names(score.user for score in scores)
+        return ScoreForms(items=[score.to_form(names.get(score.user))
+                                 for score in scores],
+                          next_cursor=next_cursor)
 
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=ScoreForms,
                       path='scores/user/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
+    @instrumented
     def get_user_scores(self, request):
-        """Returns all of an individual User's scores"""
-        user = User.query(User.name == request.user_name).get()
-        if not user:
-            raise endpoints.NotFoundException(
-                'A User with that name does not exist!')
-        scores = Score.query(Score.user == user.key)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        """Returns a page of an individual User's scores"""
+        user, scores, next_cursor = self._fetch_user_page(request, Score)
+        return ScoreForms(items=[score.to_form(user.name) for score in scores],
+                          next_cursor=next_cursor)
 
     @endpoints.method(request_message=HighScoresForm,
                       response_message=ScoreForms,
                       path='high_scores',
                       name='get_high_scores',
                       http_method='GET')
+    @instrumented
+    @rate_limited
     def get_high_scores(self, request):
         """Returns a list of the highest scoring games."""
-        scores = Score.query().order(-Score.points).fetch(limit=request.number_of_results)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        entries = HighScoreCache.get(request.number_of_results,
+                                     self._load_high_scores)
+        if entries is None:
+            entries = self._load_high_scores(request.number_of_results)
+        return ScoreForms(items=[
+            ScoreForm(points=points, date=date, user_name=user_name, won=won,
+                      guesses=guesses, forfeited=forfeited)
+            for points, date, user_name, won, guesses, forfeited, _
+            in entries])
 
     @endpoints.method(response_message=StringMessage,
                       path='games/attempts_remaining',
                       name='get_attempts_remaining',
                       http_method='GET')
+    @instrumented
+    @rate_limited
     def get_attempts_remaining(self, request):
-        """Get the cached number of moves remaining"""
-        return StringMessage(message=memcache.get(MEMCACHE_GUESSES_REMAINING) or '')
+        """Get the number of moves remaining over all active games"""
+        message = ResponseCache.get(
+            MEMCACHE_GUESSES_REMAINING, GUESSES_REMAINING_TIME,
+            lambda: 'The number of remaining guesses is {}'.format(
+                AttemptsRemainingShard.total()))
+        return StringMessage(message=message)
 
     # get_user_games
     # This returns all of a User's active games.
-    # You may want to modify the User and Game models to simplify this type of query.
-    # Hint: it might make sense for each game to be a descendant of a User.
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=GameForms,
                       path="user/games/{user_name}",
                       name="get_user_games",
                       http_method="GET")
+    @instrumented
     def get_user_games(self, request):
-        """Returns all active games for user"""
-        user = User.query(User.name == request.user_name).get()
-        if not user:
-            raise endpoints.NotFoundException(
-                'A User with that name does not exist!')
-        games = Game.query(Game.user == user.key, Game.game_over == False).fetch()
-        return GameForms(items=[game.to_form("") for game in games])
+        """Returns a page of the user's active games"""
+        user, games, next_cursor = self._fetch_user_page(
+            request, Game, Game.game_over == False)
+        return GameForms(items=[game.to_form("", user.name) for game in games],
+                         next_cursor=next_cursor)
 
     # cancel_game
     # This endpoint allows users to cancel a game in progress.
@@ -195,12 +510,13 @@ class HangmanApi(remote.Service):
                       path='game/{urlsafe_game_key}',
                       name='cancel_game',
                       http_method='DELETE')
+    @instrumented
     def cancel_game(self, request):
         """Cancel an active game"""
 
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game = self._delete_game(self._game_key(request.urlsafe_game_key))
         if game and not game.game_over:
-            game.key.delete()
+            GameCache.invalidate(game.key)
             return StringMessage(message='Game with key: {} deleted.'.
                                  format(request.urlsafe_game_key))
         elif game and game.game_over:
@@ -209,47 +525,366 @@ class HangmanApi(remote.Service):
             raise endpoints.NotFoundException('Game not found!')
 
     # get user ranking
-    @endpoints.method(response_message=UserForms,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=UserForms,
                       path='user/ranking',
                       name='get_user_rankings',
                       http_method='GET')
+    @instrumented
+    @rate_limited
     def get_user_rankings(self, request):
-        """Return list of users ranked in descending order of total score"""
-        rankings = []
-        users = User.query().fetch()
-        for user in users:
-            user_score = Score.query(Score.user==user.key).order(-Score.points).fetch()
-            total_score = sum([score.points for score in user_score])
-            rankings.append((user,total_score))
-        rankings.sort(key=lambda tup: tup[1], reverse=True)
-        return UserForms(items=[result[0].to_form(result[1]) for result in rankings])
+        """Return a page of users ranked in descending order of total score.
+        The first page is served from a copy refreshed every
+        RANKINGS_TIME seconds."""
+        def fetch():
+            return fetch_page(
+                UserRanking.query().order(-UserRanking.total_score),
+                request.page_size, request.cursor)
+        if request.cursor:
+            rankings, next_cursor = fetch()
+        else:
+            rankings, next_cursor = ResponseCache.get(
+                'UserRankings:{}'.format(request.page_size), RANKINGS_TIME,
+                fetch)
+        return UserForms(items=[ranking.to_form() for ranking in rankings],
+                         next_cursor=next_cursor)
+
+    @endpoints.method(request_message=PERIOD_RANKING_REQUEST,
+                      response_message=UserForms,
+                      path='user/ranking/{window}',
+                      name='get_period_rankings',
+                      http_method='GET')
+    @instrumented
+    def get_period_rankings(self, request):
+        """Return a page of users ranked by the total score of the games they
+        finished on a day (window 'daily'), in an ISO week ('weekly') or
+        ever ('all_time'). date, as YYYY-MM-DD, picks the day or week and
+        defaults to today."""
+        if request.window == ALL_TIME:
+            query = UserRanking.query()
+        elif request.window in PeriodRanking.RETENTION:
+            try:
+                day = (datetime.strptime(request.date, '%Y-%m-%d').date()
+                       if request.date else date.today())
+            except ValueError:
+                raise endpoints.BadRequestException(
+                    'date must be formatted as YYYY-MM-DD')
+            period = PeriodRanking.period_name(request.window, day)
+            query = PeriodRanking.query(PeriodRanking.period == period)
+        else:
+            raise endpoints.BadRequestException(
+                'window must be one of daily, weekly or all_time')
+        rankings, next_cursor = fetch_page(
+            query.order(-UserRanking.total_score),
+            request.page_size, request.cursor)
+        return UserForms(items=[ranking.to_form() for ranking in rankings],
+                         next_cursor=next_cursor)
 
     # get game history
-    @endpoints.method(request_message=GET_GAME_REQUEST,
+    @endpoints.method(request_message=GAME_PAGE_REQUEST,
                       response_message=HistoryForms,
                       path='game/{urlsafe_game_key}/history',
                       name='get_game_history',
                       http_method='GET')
+    @instrumented
     def get_game_history(self, request):
-        """Returns a history of all guesses made in game."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        """Returns a page of the history of guesses made in game. Moves kept
+        on the Game are bounded by the alphabet and returned in one page.
+        Archived games are read from their archive."""
+        game_key = self._game_key(request.urlsafe_game_key)
+        game = game_key.get() or GameArchive.get_game(game_key)
         if not game:
             raise endpoints.ConflictException('Cannot find game with key {}'.
                                               format(request.urlsafe_game_key))
+        elif not game.has_legacy_history():
+            return HistoryForms(items=[move.to_form() for move in game.moves])
         else:
-            history = History.query(ancestor=game.key).order(History.order)
-            return HistoryForms(items=[guess.to_form() for guess in history])
+            history, next_cursor = fetch_page(
+                History.query(ancestor=game.key).order(History.order),
+                request.page_size, request.cursor)
+            return HistoryForms(items=[guess.to_form() for guess in history],
+                                next_cursor=next_cursor)
+
+    @staticmethod
+    def _check_difficulty(difficulty):
+        if difficulty and difficulty not in DIFFICULTIES:
+            raise endpoints.BadRequestException(
+                'difficulty must be one of {}'.format(
+                    ', '.join(DIFFICULTIES)))
+
+    @staticmethod
+    def _fetch_user_page(request, model, *filters):
+        """Returns the User named by request.user_name with a page of its
+        entities of model, a Game or Score, that match filters. They are
+        read with a keys-only ancestor query followed by a batched get. The
+        query runs on the key the name maps to while the User is read.
+        Raises NotFoundException if there is no such User."""
+        if not request.user_name or not User.normalize(request.user_name):
+            raise endpoints.NotFoundException(
+                'A User with that name does not exist!')
+        user_key = User.key_for(request.user_name)
+        page = fetch_page_async(model.query(*filters, ancestor=user_key),
+                                request.page_size, request.cursor,
+                                keys_only=True)
+        user = User.get_by_name(request.user_name)
+        if not user:
+            raise endpoints.NotFoundException(
+                'A User with that name does not exist!')
+        if user.key != user_key:
+            # Not yet rekeyed by name: the user's older entities are not in
+            # its entity group, so they are found by their user property
+            page = fetch_page_async(model.query(model.user == user.key,
+                                                *filters),
+                                    request.page_size, request.cursor,
+                                    keys_only=True)
+        keys, next_cursor = page.get_result()
+        return (user, [entity for entity in ndb.get_multi(keys) if entity],
+                next_cursor)
+
+    @staticmethod
+    def _game_key(urlsafe):
+        """Returns the key of the game a urlsafe game key was handed out
+        for, following it if the game has been moved under its user"""
+        return MovedGame.resolve(get_key_by_urlsafe(urlsafe, Game))
+
+    @staticmethod
+    def _load_high_scores(number_of_results):
+        """Returns HighScoreCache entries for the best scores in the
+        Datastore"""
+        scores = Score.query().order(-Score.points).fetch(
+            limit=number_of_results)
+        names = get_user_names(score.user for score in scores)
+        return [HighScoreCache.entry(score, names.get(score.user))
+                for score in scores]
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _delete_game(game_key):
+        """Deletes an active game and takes its attempts off the counter,
+        both at once. Returns the game as it was, or None if it does not
+        exist; finished games are left alone."""
+        game = game_key.get()
+        if game and not game.game_over:
+            ndb.Future.wait_all([
+                game_key.delete_async(),
+                AttemptsRemainingShard.add_async(-game.attempts_remaining)])
+        return game
 
     @staticmethod
     def _cache_attempts():
-        """Populates memcache with the total remaining number of guesses for all
-        incomplete games."""
-        games = Game.query(Game.game_over == False).fetch()
-        if games:
-            count = len(games)
-            total_attempts_remaining = sum([game.attempts_remaining
-                                            for game in games])
-            memcache.set(MEMCACHE_GUESSES_REMAINING,
-                         'The number of remaining guesses is {}'.format(total_attempts_remaining))
+        """Recounts the total remaining number of guesses for all incomplete
+        games and stores it in the sharded counter, correcting any drift.
+        Deltas applied while the games are being counted may be lost until
+        the next run."""
+        total_attempts_remaining = sum(
+            game.attempts_remaining for game in
+            Game.query(Game.game_over == False).iter(
+                projection=[Game.attempts_remaining],
+                batch_size=REBUILD_BATCH_SIZE))
+        AttemptsRemainingShard.reset(total_attempts_remaining)
+        ResponseCache.invalidate(MEMCACHE_GUESSES_REMAINING)
+
+    @staticmethod
+    def _expire_rankings():
+        """Deletes the daily and weekly rankings past their expiry date.
+        Returns True if some are left for another run."""
+        query = PeriodRanking.query(PeriodRanking.expires < date.today())
+        for _ in range(EXPIRE_BATCHES):
+            keys = query.fetch(REBUILD_BATCH_SIZE, keys_only=True)
+            ndb.delete_multi(keys)
+            if len(keys) < REBUILD_BATCH_SIZE:
+                return False
+        return True
+
+    @staticmethod
+    def _archive_games(cursor=None, legacy=False):
+        """Archives the games that ended more than ARCHIVE_AFTER ago, a
+        batch at a time, starting from cursor. With legacy, archives the
+        finished games that ended before their end time was recorded
+        instead, scanning all finished games. Returns the cursor to
+        continue from in another request, or None when done."""
+        if legacy:
+            query = Game.query(Game.game_over == True).order(Game.key)
+        else:
+            query = Game.query(Game.game_over == True,
+                               Game.ended_at < datetime.now() - ARCHIVE_AFTER)
+        for _ in range(ARCHIVE_BATCHES):
+            games, cursor, more = query.fetch_page(
+                ARCHIVE_BATCH_SIZE, start_cursor=cursor)
+            HangmanApi._archive_batch([game for game in games
+                                       if not legacy or not game.ended_at])
+            if not more:
+                return None
+        return cursor
+
+    @staticmethod
+    def _archive_batch(games):
+        """Replaces finished games and their History by archives. The
+        archives are put before the games are deleted, so a retry after a
+        failure archives the same games again."""
+        history_keys = []
+        for game in games:
+            history_keys.extend(game.fold_legacy_history())
+        ndb.put_multi([GameArchive.pack(game) for game in games])
+        ndb.delete_multi([game.key for game in games] + history_keys)
+
+    @staticmethod
+    def _rebuild_rankings():
+        """Recomputes every UserRanking from the stored Scores. Used to
+        backfill the rankings of users that played before they existed."""
+        rankings = {}
+        for user in User.query().iter(batch_size=REBUILD_BATCH_SIZE):
+            rankings[user.key] = UserRanking(key=UserRanking.key_for(user.key),
+                                             user_name=user.name)
+        for score in Score.query().iter(batch_size=REBUILD_BATCH_SIZE):
+            if score.user in rankings:
+                rankings[score.user].record(score)
+        rankings = rankings.values()
+        for i in range(0, len(rankings), REBUILD_BATCH_SIZE):
+            ndb.put_multi(rankings[i:i + REBUILD_BATCH_SIZE])
+
+    @staticmethod
+    def _migrate_users(cursor=None):
+        """Rekeys one batch of users stored with numeric ids by their
+        normalized name. Returns the cursor of the next batch, or None when
+        all users have been read. Users sort by key with numeric ids first,
+        so the run is over once a batch ends on a rekeyed user."""
+        users, next_cursor, more = User.query().order(User.key).fetch_page(
+            MIGRATE_BATCH_SIZE, start_cursor=cursor)
+        for user in users:
+            if user.is_legacy():
+                HangmanApi._migrate_user(user)
+        if more and users and users[-1].is_legacy():
+            return next_cursor
+        return None
+
+    @staticmethod
+    def _migrate_user(user):
+        """Moves a legacy user's games, scores and rankings to the user's
+        name key. Every step can be repeated, so a retried task resumes
+        where the last attempt stopped. Users whose normalized name is taken
+        by another name are left alone."""
+        new_key = User.key_for(user.name)
+        new_user = HangmanApi._create_migrated_user(new_key, user)
+        if new_user.name != user.name:
+            logging.error('Cannot migrate user %s: %s is taken by %s',
+                          user.key.id(), new_key.id(), new_user.name)
+            return
+        game_query = Game.query(Game.user == user.key)
+        for game_keys in HangmanApi._key_batches(game_query):
+            HangmanApi._move_games(game_keys, new_key)
+        score_query = Score.query(Score.user == user.key)
+        for score_keys in HangmanApi._key_batches(score_query):
+            HangmanApi._move_scores(score_keys, new_key)
+        HangmanApi._move_rankings(user.key, new_key)
+
+    @staticmethod
+    def _key_batches(query):
+        """Yields the keys matching query in batches, for queries whose
+        results stop matching once they are processed"""
+        while True:
+            keys = query.fetch(REBUILD_BATCH_SIZE, keys_only=True)
+            if not keys:
+                return
+            yield keys
+
+    @staticmethod
+    @ndb.transactional
+    def _create_migrated_user(key, user):
+        """Returns the user stored under key, storing a copy of user there
+        first if there is none"""
+        new_user = key.get()
+        if not new_user:
+            new_user = User(key=key, name=user.name, email=user.email,
+                            seen_words=user.seen_words)
+            new_user.put()
+        return new_user
+
+    @staticmethod
+    def _parent_entities(model, cursor=None):
+        """Moves one batch of the Games or Scores, as model says, stored
+        before they were children of their User under their user. Returns
+        the cursor of the next batch, or None when all have been moved.
+        Root entities sort before the children of Users, so the run is over
+        once a batch reaches a child."""
+        keys, next_cursor, more = model.query().order(model.key).fetch_page(
+            REBUILD_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        root_keys = [key for key in keys if not key.parent()]
+        if model is Game:
+            HangmanApi._move_games(root_keys)
+        else:
+            HangmanApi._move_scores(root_keys)
+        if more and len(root_keys) == len(keys):
+            return next_cursor
+        return None
+
+    @staticmethod
+    def _move_games(game_keys, user_key=None):
+        """Moves games under user_key, or under their own user if None.
+        Each move leaves a MovedGame behind for the old key and folds any
+        History children into the game's moves."""
+        for i in range(0, len(game_keys), MIGRATE_TRANSACTION_GAMES):
+            moved = HangmanApi._move_game_batch(
+                game_keys[i:i + MIGRATE_TRANSACTION_GAMES], user_key)
+            for old_key, _ in moved:
+                GameCache.invalidate(old_key)
+            GameCache.set_multi([game for _, game in moved])
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _move_game_batch(game_keys, user_key):
+        """Moves a batch of games and returns (old key, game) pairs for the
+        games that were still there"""
+        moved, entities, old_keys = [], [], []
+        for game in ndb.get_multi(game_keys):
+            if not game:
+                continue
+            old_key = game.key
+            old_keys.extend(game.fold_legacy_history())
+            game.user = user_key or game.user
+            game.key = ndb.Key(Game, old_key.id(), parent=game.user)
+            entities.append(game)
+            entities.append(MovedGame(key=MovedGame.key_for(old_key),
+                                      game=game.key))
+            old_keys.append(old_key)
+            moved.append((old_key, game))
+        ndb.Future.wait_all(ndb.put_multi_async(entities) +
+                            ndb.delete_multi_async(old_keys))
+        return moved
+
+    @staticmethod
+    def _move_scores(score_keys, user_key=None):
+        """Moves scores under user_key, or under their own user if None.
+        Scores are never updated, so no transaction is needed: the copies
+        are put before the originals are deleted and a retry redoes both."""
+        scores = [score for score in ndb.get_multi(score_keys) if score]
+        old_keys = [score.key for score in scores]
+        for score in scores:
+            score.user = user_key or score.user
+            score.key = ndb.Key(Score, score.key.id(), parent=score.user)
+        ndb.put_multi(scores)
+        ndb.delete_multi(old_keys)
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _move_rankings(old_key, new_key):
+        """Adds the old user's rankings to the new user's and deletes the old
+        user with its rankings, all at once so no score is counted twice"""
+        old_rankings = (UserRanking.query(ancestor=old_key).fetch() +
+                        PeriodRanking.query(ancestor=old_key).fetch())
+        old_keys = [old_key] + [ranking.key for ranking in old_rankings]
+        new_keys = [ndb.Key(ranking.key.kind(), ranking.key.id(),
+                            parent=new_key) for ranking in old_rankings]
+        new_rankings = ndb.get_multi(new_keys)
+        for i, ranking in enumerate(old_rankings):
+            if new_rankings[i]:
+                new_rankings[i].total_score += ranking.total_score
+                new_rankings[i].wins += ranking.wins
+                new_rankings[i].games_played += ranking.games_played
+            else:
+                ranking.key = new_keys[i]
+                new_rankings[i] = ranking
+        ndb.put_multi(new_rankings)
+        ndb.delete_multi(old_keys)
 
 api = endpoints.api_server([HangmanApi])
@@ -0,0 +1,232 @@
+"""bench_api.py - Load test of the HangmanApi endpoints against the App
+Engine testbed stubs (datastore, memcache, taskqueue, mail). Each round
+scripts the traffic of a batch of players: create_user, new_game, guesses
+until the game ends, and the leaderboard reads in between. The same players
+then play as many games again through the batch endpoints, new_games and
+make_guesses. After every round it prints per-endpoint p50/p99 latency, the
+mean latency per game or guess handled, and RPC counts, so the cost of each
+endpoint can be followed as users, games and scores grow, and the batch
+endpoints compared with the single calls. Needs the App Engine SDK, see
+testbed.py:
+
+    python benchmarks/bench_api.py [--rounds N] [--users-per-round N]
+                                   [--games-per-user N] [--seed N]
+                                   [--save FILE] [--compare FILE]
+
+--save writes the latencies of every round to FILE as JSON. --compare reads
+such a file, e.g. saved from another revision, and adds the change in p50
+latency of each endpoint to the report.
+"""
+
+import argparse
+import collections
+import json
+import random
+import timeit
+
+import testbed
+testbed.setup_sdk()
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import ndb
+from protorpc import message_types
+
+from api import HangmanApi, USER_REQUEST, NEW_GAME_REQUEST, GUESS_REQUEST,\
+    GET_GAME_REQUEST, PAGE_REQUEST, MAX_BATCH_SIZE
+from cache import RateLimiter
+from models import HighScoresForm, NewGamesForm, GuessesForm, BatchGuessForm
+from words import ALPHABET
+
+SERVICES = ('datastore_v3', 'memcache', 'taskqueue', 'mail')
+
+
+class RpcCounter(object):
+    """Counts the service calls made through the API proxy"""
+
+    def __init__(self):
+        self.counts = collections.Counter()
+
+    def install(self):
+        def count(service, call, request, response):
+            self.counts[service] += 1
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'bench_rpc_counter', count)
+
+
+class Recorder(object):
+    """Latency and RPC samples for each endpoint"""
+
+    def __init__(self, counter):
+        self.counter = counter
+        self.latencies = collections.defaultdict(list)
+        self.items = collections.Counter()
+        self.rpcs = collections.defaultdict(collections.Counter)
+
+    def call(self, name, method, request, items=1):
+        """Calls an endpoint method that handles items games or guesses"""
+        # Each call is a separate request, so it starts with a cold context
+        ndb.get_context().clear_cache()
+        before = self.counter.counts.copy()
+        start = timeit.default_timer()
+        try:
+            return method(request)
+        finally:
+            self.latencies[name].append(timeit.default_timer() - start)
+            self.items[name] += items
+            calls = self.counter.counts - before
+            self.rpcs[name].update(calls)
+
+    def report(self, title, baseline=None):
+        """Prints the samples since the last report and returns the p50 and
+        p99 latency of each endpoint, in ms. baseline holds the same for an
+        earlier run, to print the change in p50 against."""
+        print
+        print title
+        print '{:24} {:>7} {:>9} {:>9} {:>9} {}{}'.format(
+            'endpoint', 'calls', 'p50 ms', 'p99 ms', 'ms/item',
+            '  '.join('{:>9}'.format(s[:9]) for s in SERVICES),
+            '  {:>9}'.format('p50 diff') if baseline is not None else '')
+        latencies = {}
+        for name in sorted(self.latencies):
+            samples = sorted(self.latencies[name])
+            p50 = percentile(samples, 50) * 1000
+            p99 = percentile(samples, 99) * 1000
+            latencies[name] = [p50, p99]
+            diff = ''
+            if baseline and name in baseline:
+                diff = '  {:>+8.0f}%'.format(
+                    (p50 / baseline[name][0] - 1) * 100
+                    if baseline[name][0] else 0)
+            print '{:24} {:>7} {:>9.2f} {:>9.2f} {:>9.3f} {}{}'.format(
+                name, len(samples), p50, p99,
+                sum(samples) * 1000 / self.items[name],
+                '  '.join('{:>9.1f}'.format(
+                    self.rpcs[name][s] / float(len(samples)))
+                    for s in SERVICES), diff)
+        self.latencies.clear()
+        self.items.clear()
+        self.rpcs.clear()
+        return latencies
+
+
+def percentile(samples, p):
+    """Returns the p-th percentile of sorted samples"""
+    index = min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))
+    return samples[index]
+
+
+def play_round(api, recorder, first_user, users, games_per_user, rng):
+    """Scripts the traffic of users players"""
+    for n in range(first_user, first_user + users):
+        name = 'player{}'.format(n)
+        recorder.call('create_user', api.create_user,
+                      USER_REQUEST.combined_message_class(
+                          user_name=name, email=name + '@example.com'))
+        for _ in range(games_per_user):
+            game = recorder.call('new_game', api.new_game,
+                                 NEW_GAME_REQUEST.combined_message_class(
+                                     user_name=name))
+            letters = list(ALPHABET)
+            rng.shuffle(letters)
+            for letter in letters:
+                state = recorder.call('make_guess', api.make_guess,
+                                      GUESS_REQUEST.combined_message_class(
+                                          urlsafe_game_key=game.urlsafe_key,
+                                          guess=letter))
+                recorder.call('get_game', api.get_game,
+                              GET_GAME_REQUEST.combined_message_class(
+                                  urlsafe_game_key=game.urlsafe_key))
+                if state.game_over:
+                    break
+            recorder.call('get_high_scores', api.get_high_scores,
+                          HighScoresForm(number_of_results=10))
+            recorder.call('get_user_rankings', api.get_user_rankings,
+                          PAGE_REQUEST.combined_message_class(page_size=20))
+        recorder.call('get_attempts_remaining', api.get_attempts_remaining,
+                      message_types.VoidMessage())
+
+
+def play_batch_round(api, recorder, first_user, users, games_per_user, rng):
+    """Plays games_per_user more games for each of the users players through
+    new_games and make_guesses, with up to MAX_BATCH_SIZE games or guesses
+    per call"""
+    names = ['player{}'.format(n)
+             for n in range(first_user, first_user + users)]
+    step = max(1, MAX_BATCH_SIZE // games_per_user)
+    games = []
+    for i in range(0, len(names), step):
+        batch = recorder.call(
+            'new_games', api.new_games,
+            NewGamesForm(user_names=names[i:i + step],
+                         games_per_user=games_per_user),
+            len(names[i:i + step]) * games_per_user)
+        games.extend(result.game.urlsafe_key for result in batch.items
+                     if result.game)
+    # The letters each game has left to guess, in the order they are guessed
+    letters = {}
+    for game in games:
+        letters[game] = list(ALPHABET)
+        rng.shuffle(letters[game])
+    while letters:
+        active = list(letters)
+        for i in range(0, len(active), MAX_BATCH_SIZE):
+            batch = active[i:i + MAX_BATCH_SIZE]
+            results = recorder.call(
+                'make_guesses', api.make_guesses,
+                GuessesForm(items=[
+                    BatchGuessForm(urlsafe_game_key=game,
+                                   guess=letters[game][0])
+                    for game in batch]),
+                len(batch))
+            for game, result in zip(batch, results.items):
+                # A guess that could not be saved is made again
+                if result.game:
+                    letters[game].pop(0)
+                    if result.game.game_over or not letters[game]:
+                        del letters[game]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rounds', type=int, default=4)
+    parser.add_argument('--users-per-round', type=int, default=25)
+    parser.add_argument('--games-per-user', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help='write the latencies to this file')
+    parser.add_argument('--compare',
+                        help='compare with latencies saved by --save')
+    args = parser.parse_args()
+    baselines = []
+    if args.compare:
+        with open(args.compare) as saved:
+            baselines = json.load(saved)
+
+    # Every player plays from this one process, and as fast as it can
+    RateLimiter.ENABLED = False
+    bed = testbed.activate()
+    try:
+        counter = RpcCounter()
+        counter.install()
+        recorder = Recorder(counter)
+        api = HangmanApi()
+        rng = random.Random(args.seed)
+        rounds = []
+        for i in range(args.rounds):
+            play_round(api, recorder, i * args.users_per_round,
+                       args.users_per_round, args.games_per_user, rng)
+            play_batch_round(api, recorder, i * args.users_per_round,
+                             args.users_per_round, args.games_per_user, rng)
+            users = (i + 1) * args.users_per_round
+            rounds.append(recorder.report(
+                'Round {}: {} users, {} games'.format(
+                    i + 1, users, 2 * users * args.games_per_user),
+                baselines[i] if i < len(baselines) else None))
+    finally:
+        bed.deactivate()
+    if args.save:
+        with open(args.save, 'w') as saved:
+            json.dump(rounds, saved, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""bench_game_entity.py - Compares the stored size and put latency of a Game
+kept as strings (past_guesses and word_state, as games used to be stored)
+with the same game kept as a guessed-letter mask. Needs the App Engine SDK,
+see testbed.py:
+
+    python benchmarks/bench_game_entity.py
+"""
+
+import timeit
+
+import testbed
+testbed.setup_sdk()
+
+from google.appengine.ext import ndb
+
+from models import Game, User
+from words import letter_mask, reveal
+
+PUTS = 500
+
+
+def legacy_game(user_key, word, letters):
+    """A game laid out as it was before the guessed mask"""
+    return Game(user=user_key, target_word=word,
+                legacy_word_state=reveal(word, letter_mask(letters)),
+                legacy_past_guesses=list(letters),
+                attempts_allowed=7, attempts_remaining=7)
+
+
+def compact_game(user_key, word, letters):
+    return Game(user=user_key, target_word=word, word_mask=letter_mask(word),
+                guessed=letter_mask(letters),
+                attempts_allowed=7, attempts_remaining=7)
+
+
+def put_latency(make_game, user_key, word, letters):
+    """Returns the mean latency of putting fresh games, in ms. The pre-put
+    hook would convert legacy games, so it is bypassed by putting the
+    protobufs directly."""
+    games = [make_game(user_key, word, letters) for _ in range(PUTS)]
+    start = timeit.default_timer()
+    for game in games:
+        ndb.get_context()._conn.put([game])
+    return (timeit.default_timer() - start) / PUTS * 1000
+
+
+def main():
+    bed = testbed.activate()
+    try:
+        user_key = User(name='bench').put()
+        word, letters = 'butterfly', 'etaoinsrh'
+        print '{:8} {:>10} {:>12}'.format('layout', 'pb bytes', 'put ms')
+        for name, make_game in (('strings', legacy_game),
+                                ('mask', compact_game)):
+            size = make_game(user_key, word, letters)._to_pb().ByteSize()
+            latency = put_latency(make_game, user_key, word, letters)
+            print '{:8} {:>10} {:>12.3f}'.format(name, size, latency)
+    finally:
+        bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
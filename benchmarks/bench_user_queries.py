@@ -0,0 +1,126 @@
+"""bench_user_queries.py - Compares the two layouts of a user's games and
+scores: root entities found through the user property, as they used to be
+stored, and children of the User found with ancestor queries. For each
+layout it reports the latency of listing a user's active games and scores,
+and the index rows written per put, counted from the built-in indexes and
+the composite indexes of index.yaml. Needs the App Engine SDK, see
+testbed.py:
+
+    python benchmarks/bench_user_queries.py [--users N] [--games N]
+"""
+
+import argparse
+import datetime
+import os
+import timeit
+
+import testbed
+testbed.setup_sdk()
+
+from google.appengine.datastore import datastore_index
+from google.appengine.ext import ndb
+
+from models import Game, Score, User
+from words import get_dictionary
+
+ROUNDS = 200
+
+
+def index_rows(entity, composites):
+    """Returns the number of index rows a put of entity writes: one in the
+    kind index, one per key on its path in the ancestor index, two per
+    indexed property value (ascending and descending), and one per
+    matching composite index row, times the length of the path for
+    ancestor indexes"""
+    pb = entity._to_pb()
+    values = {}
+    for prop in pb.property_list():
+        values[prop.name()] = values.get(prop.name(), 0) + 1
+    depth = len(entity.key.pairs())
+    rows = 1 + depth + 2 * sum(values.values())
+    for index in composites:
+        if index.kind != entity._get_kind():
+            continue
+        combinations = 1
+        for prop in index.properties or []:
+            combinations *= values.get(prop.name, 0)
+        rows += combinations * (depth if index.ancestor else 1)
+    return rows
+
+
+def load_composites():
+    path = os.path.join(testbed.ROOT, 'index.yaml')
+    with open(path) as index_yaml:
+        return datastore_index.ParseIndexDefinitions(index_yaml).indexes
+
+
+def populate(users, games, parented):
+    """Stores users with games games and scores each, half of the games
+    finished, in the old or the new layout. Returns the user keys."""
+    user_keys = ndb.put_multi(
+        [User(key=User.key_for('{}{}'.format(parented, n)),
+              name='{}{}'.format(parented, n)) for n in range(users)])
+    entities = []
+    for user_key in user_keys:
+        for n in range(games):
+            parent = user_key if parented else None
+            entities.append(Game(
+                parent=parent, user=user_key,
+                target_word=get_dictionary().choose(), guessed=0,
+                attempts_allowed=7, attempts_remaining=7,
+                game_over=bool(n % 2)))
+            entities.append(Score(parent=parent, user=user_key,
+                                  date=datetime.date.today(), won=bool(n % 3),
+                                  guesses=n % 7, points=n % 7))
+    ndb.put_multi(entities)
+    return user_keys, entities[:2]
+
+
+def list_by_property(user_key):
+    Game.query(Game.user == user_key, Game.game_over == False).fetch(20)
+    Score.query(Score.user == user_key).fetch(20)
+
+
+def list_by_ancestor(user_key):
+    ndb.get_multi(Game.query(Game.game_over == False, ancestor=user_key)
+                  .fetch(20, keys_only=True))
+    ndb.get_multi(Score.query(ancestor=user_key).fetch(20, keys_only=True))
+
+
+def latency(list_entities, user_keys):
+    """Returns the mean latency of listing a user's games and scores, in
+    ms, with a cold context cache as in a new request"""
+    def run():
+        for user_key in user_keys:
+            ndb.get_context().clear_cache()
+            list_entities(user_key)
+    rounds = max(1, ROUNDS / len(user_keys))
+    return (timeit.timeit(run, number=rounds) /
+            (rounds * len(user_keys)) * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--games', type=int, default=50)
+    args = parser.parse_args()
+
+    bed = testbed.activate()
+    try:
+        composites = load_composites()
+        print '{:10} {:>12} {:>14} {:>15}'.format(
+            'layout', 'list ms', 'game idx rows', 'score idx rows')
+        for name, parented, list_entities in (
+                ('property', False, list_by_property),
+                ('ancestor', True, list_by_ancestor)):
+            user_keys, (game, score) = populate(args.users, args.games,
+                                                parented)
+            print '{:10} {:>12.3f} {:>14} {:>15}'.format(
+                name, latency(list_entities, user_keys),
+                index_rows(game, composites), index_rows(score, composites))
+    finally:
+        bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""bench_words.py - Micro-benchmark of applying one guess to a stored game,
+as make_guess does on every request: the original list comprehension and
+string slicing against the letter masks of words.py. Also times loading the
+word list against opening its index, and choosing a word. Runs without
+App Engine:
+
+    python benchmarks/bench_words.py [words file]
+"""
+
+import os
+import random
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from words import ALPHABET, WordDictionary, WordFilter, WordIndex,\
+    WORDS_FILE, letter_bit, letter_mask, reveal, is_solved
+
+
+def guess_strings(word, word_state, guess):
+    """Applies a guess as make_guess originally did. Returns the new word
+    state and whether the word is solved."""
+    if guess in word.lower():
+        guess_instances = [i for i, ltr in enumerate(
+            word.lower()) if ltr == guess]
+        for i in guess_instances:
+            word_state = word_state[:i] + word[i] + word_state[i + 1:]
+    return word_state, word_state == word
+
+
+def guess_masks(word, word_mask, guessed, guess):
+    """Applies a guess to a game stored as a guessed-letter mask, with the
+    letter_mask of its word stored alongside"""
+    guessed |= letter_bit(guess)
+    return reveal(word, guessed, word_mask), is_solved(word_mask, guessed)
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else WORDS_FILE
+    start = timeit.default_timer()
+    dictionary = WordDictionary.load(path)
+    print 'Loaded {} words in {:.3f}s'.format(
+        len(dictionary), timeit.default_timer() - start)
+    index_path = tempfile.mktemp(suffix='.idx')
+    dictionary.write_index(index_path)
+    try:
+        start = timeit.default_timer()
+        index = WordIndex(index_path)
+        print 'Opened their index in {:.6f}s'.format(
+            timeit.default_timer() - start)
+        seen = WordFilter()
+        for name, source in (('list', dictionary), ('index', index)):
+            best = min(timeit.repeat(lambda: source.choose(seen=seen),
+                                     number=10000, repeat=5))
+            print 'choose from {:6} {:6.2f} us per word'.format(
+                name, best / 10000 * 1e6)
+    finally:
+        os.remove(index_path)
+
+    # Each request is a game partway through: its word, the letters guessed
+    # so far and the next guess.
+    requests = []
+    for _ in range(10000):
+        word = dictionary.choose()
+        letters = list(ALPHABET)
+        random.shuffle(letters)
+        past, guess = letters[:random.randrange(6)], letters[6]
+        word_state = reveal(word, letter_mask(past))
+        requests.append((word, word_state, letter_mask(word),
+                         letter_mask(past), guess))
+    for word, word_state, word_mask, guessed, guess in requests:
+        assert guess_strings(word, word_state, guess) == \
+            guess_masks(word, word_mask, guessed, guess)
+
+    for name, run in (
+            ('strings', lambda: [guess_strings(word, word_state, guess)
+                                 for word, word_state, _, _, guess
+                                 in requests]),
+            ('masks', lambda: [guess_masks(word, word_mask, guessed, guess)
+                               for word, _, word_mask, guessed, guess
+                               in requests])):
+        best = min(timeit.repeat(run, number=1, repeat=5))
+        print '{:8} {:6.2f} us per guess'.format(name,
+                                                 best / len(requests) * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""testbed.py - Sets up the App Engine SDK and the local service stubs the
+benchmarks run against. Set APPENGINE_SDK to the SDK directory (the one
+containing dev_appserver.py) if it is not already importable."""
+
+import os
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def setup_sdk():
+    """Puts the SDK, its bundled libraries and the app on sys.path"""
+    sdk = os.environ.get('APPENGINE_SDK')
+    if sdk:
+        sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, ROOT)
+
+
+def activate():
+    """Activates a testbed with the datastore, memcache, taskqueue and mail
+    stubs and returns it. Deactivate it when done."""
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import ndb, testbed
+
+    import metrics
+
+    bed = testbed.Testbed()
+    bed.activate()
+    # The testbed replaces the API proxy the hooks were registered with
+    metrics.install_hooks()
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    # Queries need the indexes of index.yaml, as in production, and the stub
+    # does not rewrite the file
+    bed.init_datastore_v3_stub(consistency_policy=policy, root_path=ROOT,
+                               require_indexes=True)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=ROOT)
+    bed.init_mail_stub()
+    bed.init_app_identity_stub()
+    ndb.get_context().clear_cache()
+    return bed
@@ -0,0 +1,367 @@
+"""cache.py - memcache layers that keep hot entities and responses out of the
+Datastore."""
+
+import time
+
+from google.appengine.api import memcache
+
+import metrics
+
+
+def _wait_for(read, waits, wait_time):
+    """Polls read() for a value another request is computing, waits times
+    wait_time seconds apart. Returns None if it has not shown up by then."""
+    for _ in range(waits):
+        time.sleep(wait_time)
+        value = read()
+        if value is not None:
+            return value
+    return None
+
+
+class GameCache(object):
+    """Read-through/write-through memcache cache of Game entities, keyed by
+    game key. Cached games carry their version, and writes go through
+    compare-and-set so an older state can never replace a newer one.
+    Events are counted under 'GameCache.*' in metrics."""
+    PREFIX = 'Game:'
+    LOCK_PREFIX = 'Game:lock:'
+    # Left in place of cancelled games so a reader that fetched the game
+    # before it was deleted cannot cache it again.
+    TOMBSTONE = 'deleted'
+    ACTIVE_TIME = 60 * 60
+    FINISHED_TIME = 5 * 60
+    CAS_RETRIES = 3
+    # On a miss, one request reads the game while the others poll for it
+    LOCK_TIME = 10
+    WAITS = 5
+    WAIT_TIME = 0.02
+
+    @classmethod
+    def _cache_key(cls, game_key):
+        return cls.PREFIX + game_key.urlsafe()
+
+    @classmethod
+    def get(cls, game_key):
+        """Returns the Game for game_key, or None if it does not exist. Only
+        reads the Datastore on a cache miss, and then only once for
+        concurrent readers: the one that takes the lock reads the game while
+        the others wait for it to be cached."""
+        cache_key = cls._cache_key(game_key)
+        game = memcache.get(cache_key)
+        if game is not None:
+            metrics.count('GameCache.hits')
+        elif memcache.add(cls.LOCK_PREFIX + game_key.urlsafe(), 1,
+                          time=cls.LOCK_TIME):
+            metrics.count('GameCache.misses')
+            try:
+                game = game_key.get()
+                if game:
+                    memcache.add(cache_key, game, time=cls._time(game))
+            finally:
+                memcache.delete(cls.LOCK_PREFIX + game_key.urlsafe())
+            return game
+        else:
+            game = _wait_for(lambda: memcache.get(cache_key), cls.WAITS,
+                             cls.WAIT_TIME)
+            if game is None:
+                # Also the case for games that do not exist
+                metrics.count('GameCache.uncoalesced')
+                return game_key.get()
+            metrics.count('GameCache.waited')
+        return None if game == cls.TOMBSTONE else game
+
+    @classmethod
+    def set(cls, game):
+        """Writes a game's committed state through to the cache. Call after
+        the game has been put. Returns False if the entry could not be
+        updated, in which case it is dropped so the next read refetches it."""
+        return not cls.set_multi([game])
+
+    @classmethod
+    def set_multi(cls, games):
+        """Writes the committed state of several games through to the cache
+        with batched calls. Returns the keys of the games whose entries
+        could not be updated and were dropped."""
+        client = memcache.Client()
+        pending = dict((cls._cache_key(game.key), game) for game in games)
+        for _ in range(cls.CAS_RETRIES):
+            if not pending:
+                return []
+            cached = client.get_multi(pending.keys(), for_cas=True)
+            # Entries to add and to replace, by expiry time
+            writes = {}
+            for cache_key, game in pending.items():
+                entry = cached.get(cache_key)
+                if entry is not None and (entry == cls.TOMBSTONE or
+                                          entry.version >= game.version):
+                    del pending[cache_key]
+                    continue
+                writes.setdefault((entry is None, cls._time(game)), {})[
+                    cache_key] = game
+            failed = set()
+            for (new, expiry), mapping in writes.items():
+                write = client.add_multi if new else client.cas_multi
+                failed.update(write(mapping, time=expiry))
+            for cache_key in set(pending) - failed:
+                del pending[cache_key]
+        client.delete_multi(pending.keys())
+        return [game.key for game in pending.values()]
+
+    @classmethod
+    def invalidate(cls, game_key):
+        """Marks a deleted game as gone"""
+        memcache.set(cls._cache_key(game_key), cls.TOMBSTONE,
+                     time=cls.FINISHED_TIME)
+
+    @classmethod
+    def _time(cls, game):
+        # Finished games are only kept long enough to answer the last polls.
+        return cls.FINISHED_TIME if game.game_over else cls.ACTIVE_TIME
+
+
+class HighScoreCache(object):
+    """The K best scores, best first, kept in memcache with a short-lived
+    copy in the instance. Entries are (points, date, user_name, won,
+    guesses, forfeited, score key) tuples, so serving them needs no
+    Datastore read.
+    Game.end_game offers each new score, which is only written when it
+    makes the top K.
+
+    While the cache is cold, offers are kept in a pending list instead: the
+    query that rebuilds the cache is eventually consistent and may miss
+    scores committed just before or during it, so the rebuild merges the
+    pending scores into what it loaded. Entries are matched by score key,
+    so a score both loaded and offered is only listed once.
+
+    Requests that find the cache cold while another one rebuilds it are
+    served the instance's older copy, or else wait for the rebuild. Events
+    are counted under 'HighScoreCache.*' in metrics."""
+    # Versioned with the entry layout, so older entries are never unpacked
+    KEY = 'HighScores:v3'
+    PENDING_KEY = 'HighScores:pending'
+    REBUILD_LOCK = 'HighScores:rebuild'
+    K = 1000
+    # How long an instance serves its own copy before rereading memcache
+    LOCAL_TIME = 5
+    REBUILD_LOCK_TIME = 60
+    # How long offers made to a cold cache are kept for a rebuild to merge
+    PENDING_TIME = 5 * 60
+    CAS_RETRIES = 3
+    WAITS = 3
+    WAIT_TIME = 0.05
+    _local = None
+
+    @staticmethod
+    def entry(score, user_name):
+        """Returns the cache entry for a Score"""
+        return (score.points, str(score.date), user_name, score.won,
+                score.guesses, score.forfeited, score.key)
+
+    @classmethod
+    def get(cls, number_of_results, load):
+        """Returns the best number_of_results entries. When the cache is cold
+        the first caller rebuilds it with load(K), which must return the K
+        best entries from the Datastore. Returns None if number_of_results
+        is over K, or if another request is rebuilding the cache and it is
+        not done within the waits."""
+        if number_of_results > cls.K:
+            return None
+        entries = cls._entries()
+        if entries is None:
+            if memcache.add(cls.REBUILD_LOCK, 1, time=cls.REBUILD_LOCK_TIME):
+                try:
+                    entries = cls._rebuild(load)
+                finally:
+                    memcache.delete(cls.REBUILD_LOCK)
+            elif cls._local:
+                metrics.count('HighScoreCache.stale')
+                entries = cls._local[1]
+            else:
+                entries = _wait_for(cls._entries, cls.WAITS, cls.WAIT_TIME)
+                if entries is None:
+                    metrics.count('HighScoreCache.uncoalesced')
+                    return None
+                metrics.count('HighScoreCache.waited')
+        return entries[:max(number_of_results, 0)]
+
+    @classmethod
+    def _rebuild(cls, load):
+        """Refills the cache with load(K) and the pending offers. Call with
+        the rebuild lock held."""
+        metrics.count('HighScoreCache.rebuilt')
+        entries = load(cls.K)
+        memcache.set(cls.KEY, entries)
+        # Offers made from here on see the cache; earlier ones are pending.
+        pending = memcache.get(cls.PENDING_KEY)
+        if pending:
+            entries = cls._merge(pending) or entries
+        cls._local = (time.time(), entries)
+        return entries
+
+    @classmethod
+    def offer(cls, score, user_name):
+        """Adds a newly committed Score if it is among the K best"""
+        entry = cls.entry(score, user_name)
+        entries = cls._entries()
+        if entries is None:
+            cls._add_pending(entry)
+            # The cache may have been rebuilt since, without the pending
+            # entry
+            entries = memcache.get(cls.KEY)
+            if entries is None:
+                return
+        if cls._qualifies(entries, entry):
+            cls._merge([entry])
+
+    @classmethod
+    def _merge(cls, new_entries):
+        """Adds the entries among the K best to the cached ones, and returns
+        the result. Returns None if the cache is cold, and drops the cache
+        if it could not be updated."""
+        client = memcache.Client()
+        for _ in range(cls.CAS_RETRIES):
+            entries = client.gets(cls.KEY)
+            if entries is None:
+                return None
+            keys = set(entry[-1] for entry in entries)
+            added = [entry for entry in new_entries
+                     if entry[-1] not in keys and
+                     cls._qualifies(entries, entry)]
+            if not added:
+                return entries
+            # Stable sort: new scores go after existing equal ones
+            entries = sorted(entries + added,
+                             key=lambda entry: -entry[0])[:cls.K]
+            if client.cas(cls.KEY, entries):
+                cls._local = (time.time(), entries)
+                return entries
+        client.delete(cls.KEY)
+        return None
+
+    @classmethod
+    def _add_pending(cls, entry):
+        """Keeps an offer made to a cold cache for the rebuild to merge"""
+        client = memcache.Client()
+        for _ in range(cls.CAS_RETRIES):
+            pending = client.gets(cls.PENDING_KEY)
+            if pending is None:
+                if client.add(cls.PENDING_KEY, [entry],
+                              time=cls.PENDING_TIME):
+                    return
+            else:
+                pending = sorted(pending + [entry],
+                                 key=lambda entry: -entry[0])[:cls.K]
+                if client.cas(cls.PENDING_KEY, pending,
+                              time=cls.PENDING_TIME):
+                    return
+
+    @classmethod
+    def _qualifies(cls, entries, entry):
+        return len(entries) < cls.K or entry[0] > entries[-1][0]
+
+    @classmethod
+    def _entries(cls):
+        local = cls._local
+        if local and time.time() - local[0] < cls.LOCAL_TIME:
+            return local[1]
+        entries = memcache.get(cls.KEY)
+        if entries is not None:
+            cls._local = (time.time(), entries)
+        return entries
+
+
+class ResponseCache(object):
+    """Short-lived memcache copies of computed responses, refreshed by a
+    single request. When a copy expires, the request that takes the refresh
+    lock recomputes it while concurrent requests are served the expired
+    copy, so a popular key costs one recomputation instead of one per
+    request. Events are counted under 'ResponseCache.*' in metrics."""
+    PREFIX = 'Response:'
+    LOCK_PREFIX = 'Response:lock:'
+    # How long an expired copy may still be served while it is refreshed
+    STALE_TIME = 60
+    LOCK_TIME = 10
+    # When there is no copy at all, requests that do not hold the lock poll
+    # for the one being computed before computing it themselves.
+    WAITS = 3
+    WAIT_TIME = 0.05
+
+    @classmethod
+    def get(cls, key, ttl, compute):
+        """Returns the cached response for key, calling compute() for a new
+        one when the copy is older than ttl seconds"""
+        cache_key = cls.PREFIX + key
+        entry = memcache.get(cache_key)
+        if entry is not None and entry[0] > time.time():
+            metrics.count('ResponseCache.fresh')
+            return entry[1]
+        if memcache.add(cls.LOCK_PREFIX + key, 1, time=cls.LOCK_TIME):
+            try:
+                value = compute()
+                memcache.set(cache_key, (time.time() + ttl, value),
+                             time=ttl + cls.STALE_TIME)
+            finally:
+                memcache.delete(cls.LOCK_PREFIX + key)
+            metrics.count('ResponseCache.computed')
+            return value
+        if entry is not None:
+            metrics.count('ResponseCache.stale')
+            return entry[1]
+        entry = _wait_for(lambda: memcache.get(cache_key), cls.WAITS,
+                          cls.WAIT_TIME)
+        if entry is not None:
+            metrics.count('ResponseCache.waited')
+            return entry[1]
+        metrics.count('ResponseCache.uncoalesced')
+        return compute()
+
+    @classmethod
+    def invalidate(cls, key):
+        """Drops the copy of key, e.g. once it is known to be wrong"""
+        memcache.delete(cls.PREFIX + key)
+
+
+class RateLimiter(object):
+    """Token bucket per client, kept in memcache. Each client may make
+    BURST requests at once and RATE requests per second after that.
+    Buckets are updated with compare-and-set; when memcache is unavailable
+    or too contended, requests are let through. Decisions are counted
+    under 'RateLimiter.*' in metrics."""
+    PREFIX = 'RateLimit:'
+    RATE = 5.0
+    BURST = 20
+    CAS_RETRIES = 3
+    # Set to False to let every request through, e.g. in load tests that
+    # play many clients from one address
+    ENABLED = True
+
+    @classmethod
+    def allow(cls, client_id):
+        """Takes a token from the client's bucket. Returns False if it is
+        empty."""
+        if not cls.ENABLED:
+            return True
+        client = memcache.Client()
+        cache_key = cls.PREFIX + client_id
+        # A bucket left alone this long is full again
+        bucket_time = int(cls.BURST / cls.RATE) + 1
+        for _ in range(cls.CAS_RETRIES):
+            now = time.time()
+            bucket = client.gets(cache_key)
+            if bucket is None:
+                if client.add(cache_key, (cls.BURST - 1, now),
+                              time=bucket_time):
+                    metrics.count('RateLimiter.allowed')
+                    return True
+                continue
+            tokens, updated = bucket
+            tokens = min(cls.BURST, tokens + (now - updated) * cls.RATE)
+            if tokens < 1:
+                metrics.count('RateLimiter.limited')
+                return False
+            if client.cas(cache_key, (tokens - 1, now), time=bucket_time):
+                metrics.count('RateLimiter.allowed')
+                return True
+        metrics.count('RateLimiter.contended')
+        return True
@@ -2,60 +2,217 @@
 
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
+import json
 import logging
 
 import webapp2
-from google.appengine.api import mail, app_identity
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 from api import HangmanApi
-from models import User, Game
+from models import Game, Score
+import metrics
+from metrics import instrumented
+import reminders
+import sweeper
 
 class SendReminderEmail(webapp2.RequestHandler):
 
+    @instrumented
     def get(self):
         """Send a reminder email to each User with an email about games.
-        Called every 24 hours using a cron job"""
-        app_id = app_identity.get_application_id()
-        users = User.query(User.email != None)
-        for user in users:
-            subject = 'This is a reminder!'
-            body = 'Hello {}, try out Hangman!'.format(user.name)
-            # This will send test emails, the arguments to send_mail are:
-            # from, to, subject, body
-            mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                           user.email,
-                           subject,
-                           body)
+        Called every 48 hours using a cron job"""
+        reminders.start_run(reminders.REMINDER)
 
 
 class SendGamePausedReminderEmail(webapp2.RequestHandler):
 
+    @instrumented
     def get(self):
         """Send a reminder email to each User with paused hangman matches.
         Called every hour using a cron job"""
-        app_id = app_identity.get_application_id()
-        users = User.query(User.email != None)
+        reminders.start_run(reminders.PAUSED)
 
-        for user in users:
-            games = Game.query(Game.game_over == False).fetch()
 
-            if games:
-                subject = 'Paused match reminder!'
-                body = 'Hello {}, \n\nYou have games in ' \
-                       'progress:\n'.format(user.name)
+class ScanReminderRecipients(webapp2.RequestHandler):
 
-                mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                               user.email, subject, body)
+    @instrumented
+    def post(self):
+        """Enqueue the reminder emails for one page of recipients."""
+        cursor = self.request.get('cursor')
+        reminders.scan(self.request.get('run_id'), self.request.get('kind'),
+                       int(self.request.get('page')),
+                       Cursor(urlsafe=cursor) if cursor else None)
 
 
-class UpdateRemainingGuesses(webapp2.RequestHandler):
+class SendReminderBatch(webapp2.RequestHandler):
 
+    @instrumented
     def post(self):
-        """Update game listing announcement in memcache."""
+        """Send the reminder emails to a batch of users."""
+        user_keys = [ndb.Key(urlsafe=urlsafe)
+                     for urlsafe in self.request.get('users').split(',')]
+        reminders.send(self.request.get('run_id'), self.request.get('kind'),
+                       user_keys)
+
+
+class UpdateRemainingGuesses(webapp2.RequestHandler):
+
+    @instrumented
+    def get(self):
+        """Reconcile the attempts remaining counter with the active games.
+        Called every 6 hours using a cron job"""
         HangmanApi._cache_attempts()
         self.response.set_status(204)
 
+
+class RebuildUserRankings(webapp2.RequestHandler):
+
+    @instrumented
+    def post(self):
+        """Backfill the per-user ranking totals from existing Scores."""
+        HangmanApi._rebuild_rankings()
+        self.response.set_status(204)
+
+
+class MigrateUsers(webapp2.RequestHandler):
+
+    @instrumented
+    def post(self):
+        """Rekey one batch of legacy users by name, then continue with the
+        next batch in a new task."""
+        cursor = self.request.get('cursor')
+        next_cursor = HangmanApi._migrate_users(
+            Cursor(urlsafe=cursor) if cursor else None)
+        if next_cursor:
+            taskqueue.add(url='/tasks/migrate_users',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
+
+class ParentGamesAndScores(webapp2.RequestHandler):
+
+    @instrumented
+    def post(self):
+        """Move one batch of the games, then of the scores, stored outside
+        their user's entity group under their user, continuing in a new
+        task until all are moved."""
+        kind = self.request.get('kind') or 'Game'
+        cursor = self.request.get('cursor')
+        model = Score if kind == 'Score' else Game
+        next_cursor = HangmanApi._parent_entities(
+            model, Cursor(urlsafe=cursor) if cursor else None)
+        if next_cursor:
+            taskqueue.add(url='/tasks/parent_entities',
+                          params={'kind': kind,
+                                  'cursor': next_cursor.urlsafe()})
+        elif model is Game:
+            taskqueue.add(url='/tasks/parent_entities',
+                          params={'kind': 'Score'})
+        self.response.set_status(204)
+
+
+class ExpirePeriodRankings(webapp2.RequestHandler):
+
+    @instrumented
+    def get(self):
+        """Delete expired daily and weekly rankings. Called every day using a
+        cron job; continues in a task if there are too many for one
+        request."""
+        if HangmanApi._expire_rankings():
+            taskqueue.add(url='/crons/expire_rankings')
+
+    def post(self):
+        self.get()
+
+
+class SweepStaleGames(webapp2.RequestHandler):
+
+    @instrumented
+    def get(self):
+        """Forfeit the games abandoned for longer than a week. Called every
+        day using a cron job. Pass legacy=1 to sweep the active games not
+        put since Game.updated_at was added instead."""
+        sweeper.start_run(legacy=bool(self.request.get('legacy')))
+
+
+class SweepShard(webapp2.RequestHandler):
+
+    @instrumented
+    def post(self):
+        """Forfeit one page of the stale games of a sweep shard."""
+        cursor = self.request.get('cursor')
+        sweeper.sweep(self.request.get('run_id'),
+                      int(self.request.get('shard')),
+                      sweeper.parse_bounds(self.request.get('start'),
+                                           self.request.get('end')),
+                      int(self.request.get('page')),
+                      Cursor(urlsafe=cursor) if cursor else None)
+
+
+class ArchiveGames(webapp2.RequestHandler):
+
+    @instrumented
+    def get(self):
+        """Archive the games that ended more than a month ago. Called every
+        day using a cron job; continues in a task if there are too many for
+        one request. Pass legacy=1 to archive finished games that have no
+        end time instead."""
+        cursor = self.request.get('cursor')
+        legacy = bool(self.request.get('legacy'))
+        next_cursor = HangmanApi._archive_games(
+            Cursor(urlsafe=cursor) if cursor else None, legacy)
+        if next_cursor:
+            params = {'cursor': next_cursor.urlsafe()}
+            if legacy:
+                params['legacy'] = 1
+            taskqueue.add(url='/crons/archive_games', params=params)
+
+    def post(self):
+        self.get()
+
+
+class RequestStats(webapp2.RequestHandler):
+
+    def get(self):
+        """Report this instance's per-handler latency, RPC and entity
+        histograms and its game cache, rate limiter and response cache
+        counters as JSON."""
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps({'handlers': metrics.snapshot(),
+                                        'counters': metrics.counters()}))
+
+
+class SweepStats(webapp2.RequestHandler):
+
+    def get(self):
+        """Report the metrics of the recent sweeps as JSON."""
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps({'runs': sweeper.SweepStats.recent()}))
+
+
+class ReminderStats(webapp2.RequestHandler):
+
+    def get(self):
+        """Report the metrics of the recent reminder runs as JSON."""
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps({'runs': reminders.RunStats.recent()}))
+
+
 app = webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
     ('/crons/send_Paused_Game_Reminder', SendGamePausedReminderEmail),
-    ('/tasks/cache_attempts', UpdateRemainingGuesses)
+    ('/crons/expire_rankings', ExpirePeriodRankings),
+    ('/crons/archive_games', ArchiveGames),
+    ('/crons/sweep_games', SweepStaleGames),
+    ('/tasks/sweep', SweepShard),
+    ('/tasks/cache_attempts', UpdateRemainingGuesses),
+    ('/tasks/rebuild_rankings', RebuildUserRankings),
+    ('/tasks/migrate_users', MigrateUsers),
+    ('/tasks/parent_entities', ParentGamesAndScores),
+    ('/tasks/reminders/scan', ScanReminderRecipients),
+    ('/tasks/reminders/send', SendReminderBatch),
+    ('/admin/stats', RequestStats),
+    ('/admin/stats/reminders', ReminderStats),
+    ('/admin/stats/sweeps', SweepStats)
 ], debug=True)
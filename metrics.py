@@ -0,0 +1,200 @@
+"""metrics.py - Per-request RPC and latency instrumentation. Handlers wrapped
+with @instrumented record their wall time and the datastore/memcache RPCs
+they issue into in-process histograms, and requests slower than
+SLOW_REQUEST_MS are logged with their RPC trace. The RPCs are seen through
+API proxy hooks, so recording costs a few dictionary updates per RPC.
+
+Histograms are kept per instance; /admin/stats serves the ones of the
+instance that answers, along with the instance's event counters."""
+
+import functools
+import logging
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+
+SLOW_REQUEST_MS = 1000
+# Upper bounds of the histogram buckets. Latencies are in ms.
+LATENCY_BUCKETS = (5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# Datastore calls whose entity counts are recorded, with functions returning
+# the number of entities read or written from the request and response.
+ENTITY_COUNTS = {
+    'Get': lambda request, response: len(response.entity_list()),
+    'Put': lambda request, response: len(response.key_list()),
+    'Delete': lambda request, response: len(request.key_list()),
+    'RunQuery': lambda request, response: len(response.result_list()),
+    'Next': lambda request, response: len(response.result_list()),
+}
+
+_local = threading.local()
+_lock = threading.Lock()
+_stats = {}
+_counters = {}
+
+
+class Histogram(object):
+    """Counts of values falling under each bucket bound, plus their sum"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0
+        self.count = 0
+
+    def add(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.total += value
+        self.count += 1
+
+    def to_dict(self):
+        labels = ['<={}'.format(bound) for bound in self.buckets]
+        labels.append('>{}'.format(self.buckets[-1]))
+        return {'count': self.count,
+                'mean': float(self.total) / self.count if self.count else 0,
+                'buckets': dict(zip(labels, self.counts))}
+
+
+class HandlerStats(object):
+    """Histograms for one handler"""
+
+    def __init__(self):
+        self.latency_ms = Histogram(LATENCY_BUCKETS)
+        self.rpcs = {}
+        self.entities = Histogram(COUNT_BUCKETS)
+        self.slow = 0
+
+    def record(self, trace):
+        self.latency_ms.add(trace.elapsed_ms)
+        for service in set(self.rpcs) | set(trace.rpcs):
+            self.rpcs.setdefault(service, Histogram(COUNT_BUCKETS)).add(
+                trace.rpcs.get(service, 0))
+        self.entities.add(trace.entities)
+        if trace.elapsed_ms > SLOW_REQUEST_MS:
+            self.slow += 1
+
+    def to_dict(self):
+        return {'latency_ms': self.latency_ms.to_dict(),
+                'rpcs': dict((service, histogram.to_dict())
+                             for service, histogram in self.rpcs.items()),
+                'entities': self.entities.to_dict(),
+                'slow': self.slow}
+
+
+class Trace(object):
+    """The RPCs made while handling one request"""
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.elapsed_ms = 0
+        self.rpcs = {}
+        self.entities = 0
+        self.calls = []
+        self.pending = {}
+
+    def rpc_started(self, service, call, response):
+        self.rpcs[service] = self.rpcs.get(service, 0) + 1
+        self.pending[id(response)] = time.time()
+
+    def rpc_finished(self, service, call, request, response):
+        started = self.pending.pop(id(response), None)
+        if started is None:
+            return
+        entities = 0
+        if service == 'datastore_v3' and call in ENTITY_COUNTS:
+            entities = ENTITY_COUNTS[call](request, response)
+            self.entities += entities
+        self.calls.append((service, call, entities,
+                           (started - self.start) * 1000,
+                           (time.time() - started) * 1000))
+
+    def finish(self):
+        self.elapsed_ms = (time.time() - self.start) * 1000
+
+    def log(self):
+        logging.warning(
+            'Slow request %s took %.0f ms, %d entities. RPC trace:\n%s',
+            self.name, self.elapsed_ms, self.entities, '\n'.join(
+                '  +%.0f ms %s.%s %.1f ms, %d entities' %
+                (offset, service, call, duration, entities)
+                for service, call, entities, offset, duration
+                in self.calls))
+
+
+def _pre_call_hook(service, call, request, response):
+    trace = getattr(_local, 'trace', None)
+    if trace:
+        trace.rpc_started(service, call, response)
+
+
+def _post_call_hook(service, call, request, response):
+    trace = getattr(_local, 'trace', None)
+    if trace:
+        trace.rpc_finished(service, call, request, response)
+
+
+def install_hooks():
+    """Registers the API proxy hooks. Safe to call more than once."""
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'metrics', _pre_call_hook)
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+        'metrics', _post_call_hook)
+
+
+def instrumented(func):
+    """Decorates an endpoints method or webapp2 handler method so the RPCs,
+    entities and wall time of each call are recorded under
+    'ClassName.method'. Nested instrumented calls count towards the
+    outermost one."""
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if getattr(_local, 'trace', None):
+            return func(self, *args, **kwargs)
+        trace = _local.trace = Trace(
+            '{}.{}'.format(self.__class__.__name__, func.__name__))
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            _local.trace = None
+            trace.finish()
+            _record(trace)
+    return wrapper
+
+
+def _record(trace):
+    with _lock:
+        stats = _stats.get(trace.name)
+        if not stats:
+            stats = _stats[trace.name] = HandlerStats()
+        stats.record(trace)
+    if trace.elapsed_ms > SLOW_REQUEST_MS:
+        trace.log()
+
+
+def snapshot():
+    """Returns the histograms of every handler as a JSON-serializable dict"""
+    with _lock:
+        return dict((name, stats.to_dict()) for name, stats in _stats.items())
+
+
+def count(name, delta=1):
+    """Adds delta to the instance's counter of an event"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + delta
+
+
+def counters():
+    """Returns the instance's event counters"""
+    with _lock:
+        return dict(_counters)
+
+
+install_hooks()
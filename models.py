@@ -1,21 +1,84 @@
 """models.py - This file contains the class definitions for the Datastore
 entities used by the Game. Because these classes are also regular Python
 classes they can include methods (such as 'to_form' and 'new_game')."""
+import collections
+import functools
+import json
 import random
-from datetime import date
+from datetime import date, datetime, timedelta
 from protorpc import messages
 from google.appengine.ext import ndb
 
-""" Words to use in the hangman game. """
-WORDS = ("follow", "waking", "insane", "chilly",
-         "massive", "ancient", "zebra", "logical", "never", "nice")
+from cache import HighScoreCache
+from words import ALPHABET, WordFilter, get_dictionary, letter_bit,\
+    letter_mask, reveal
+
 GUESSES_ALLOWED = 7
 
 
+# Users created before they were keyed by name have numeric ids. Set to
+# False once /tasks/migrate_users has rekeyed them, so that a missing user
+# costs a get and no query.
+LEGACY_USER_LOOKUP = True
+
+
 class User(ndb.Model):
-    """User profile"""
+    """User profile. Keyed by the normalized user name, so looking a user up
+    by name is a strongly consistent get."""
     name = ndb.StringProperty(required=True)
     email = ndb.StringProperty()
+    # WordFilter of the words the user has been given, so new games avoid
+    # repeating them
+    seen_words = ndb.BlobProperty()
+
+    @staticmethod
+    def normalize(name):
+        """Returns the form of a user name used as key"""
+        return name.strip().lower()
+
+    @classmethod
+    def key_for(cls, name):
+        """Returns the key of the user with the given name"""
+        return ndb.Key(cls, cls.normalize(name))
+
+    @classmethod
+    def get_by_name(cls, name):
+        """Returns the user with the given name, or None"""
+        return cls.get_by_name_async(name).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_by_name_async(cls, name):
+        users = yield cls.get_by_names_async([name])
+        raise ndb.Return(users[name])
+
+    @classmethod
+    def get_by_names(cls, names):
+        """Returns a dict mapping each name to its user, or None, with one
+        batched get. Names of the same user, such as 'Bob' and 'bob', map to
+        the same User object. Users with legacy keys are found with a
+        query."""
+        return cls.get_by_names_async(names).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_by_names_async(cls, names):
+        names = [name for name in set(names) if name and cls.normalize(name)]
+        keys = [cls.key_for(name) for name in names]
+        unique_keys = list(set(keys))
+        found = yield ndb.get_multi_async(unique_keys)
+        found = dict(zip(unique_keys, found))
+        users = dict((name, found[key]) for name, key in zip(names, keys))
+        if LEGACY_USER_LOOKUP:
+            missing = [name for name, user in users.items() if not user]
+            found = yield [cls.query(cls.name == name).get_async()
+                           for name in missing]
+            users.update(zip(missing, found))
+        raise ndb.Return(collections.defaultdict(lambda: None, users))
+
+    def is_legacy(self):
+        """True if the user still has a numeric key"""
+        return not isinstance(self.key.id(), basestring)
 
     def to_form(self, total_score):
         form = UserForm()
@@ -24,75 +87,446 @@ class User(ndb.Model):
         return form
 
 
+class Move(ndb.Model):
+    """A guess and its result, stored inside the Game it was made in"""
+    guess = ndb.StringProperty(required=True)
+    message = ndb.StringProperty(required=True)
+
+    def to_form(self):
+        return HistoryForm(guess=self.guess, message=self.message)
+
+
 class Game(ndb.Model):
     """Game object"""
     user = ndb.KeyProperty(required=True, kind='User')
+    user_name = ndb.StringProperty(indexed=False)
     target_word = ndb.StringProperty(required=True)
-    word_state = ndb.StringProperty(required=True)
+    # letter_mask of the target word, so a guess is checked without
+    # rescanning it. None for games stored before it existed, until their
+    # next put.
+    word_mask = ndb.IntegerProperty(indexed=False)
+    # Mask of the letters guessed so far, see words.py. None for games
+    # stored before it existed, until their next put.
+    guessed = ndb.IntegerProperty(indexed=False)
     attempts_remaining = ndb.IntegerProperty(required=True, default=7)
-    past_guesses = ndb.StringProperty(repeated=True)
     game_over = ndb.BooleanProperty(required=True, default=False)
     attempts_allowed = ndb.IntegerProperty(required=True)
+    # Moves in the order they were made. Games created before moves were
+    # kept here have their moves stored as History children instead.
+    moves = ndb.LocalStructuredProperty(Move, repeated=True, compressed=True)
+    # Bumped on every put so cached copies can tell which state is newer.
+    version = ndb.IntegerProperty(default=0, indexed=False)
+    # When the game ended. None for games still in progress and for games
+    # that ended before it was recorded.
+    ended_at = ndb.DateTimeProperty()
+    # Time of the last put, used to find abandoned games. None for games
+    # not put since it was added.
+    updated_at = ndb.DateTimeProperty(auto_now=True)
+    # Older games stored their guesses and revealed word as strings. They
+    # are converted to the guessed mask when the game is next put.
+    legacy_word_state = ndb.StringProperty('word_state', indexed=False)
+    legacy_past_guesses = ndb.StringProperty('past_guesses', repeated=True)
 
     @classmethod
-    def new_game(cls, userKey):
-        """Creates and returns a new game"""
-        word = random.choice(WORDS)
-        word_state = "_" * len(word)
-        game = Game(user=userKey,
-                    target_word=word,
-                    attempts_allowed=GUESSES_ALLOWED,
-                    attempts_remaining=GUESSES_ALLOWED,
-                    word_state=word_state)
-
-        game.put()
+    @ndb.transactional(xg=True)
+    def new_game(cls, userKey, user_name=None, difficulty=None):
+        """Creates and returns a new game with a word of the given
+        difficulty, or any, that the user has not seen. Its attempts are
+        added to the attempts remaining counter in the same transaction,
+        while the game and the user's seen words are put."""
+        user = userKey.get()
+        seen = WordFilter(user.seen_words if user else None)
+        game = cls.create(userKey, user_name, difficulty, seen)
+        entities = [game]
+        if user:
+            user.seen_words = seen.to_bytes()
+            entities.append(user)
+        ndb.Future.wait_all(ndb.put_multi_async(entities) + [
+            AttemptsRemainingShard.add_async(game.attempts_remaining)])
         return game
 
-    def save_history(self, guess, message, order):
-        """Saves the last made move to history"""
-        move = History(parent=self.key,
-                       guess=guess,
-                       message=message,
-                       order=order)
-        move.put()
+    @classmethod
+    @ndb.transactional_tasklet(xg=True)
+    def new_games_async(cls, userKey, user_name, count, difficulty=None,
+                        shard=None):
+        """Creates count games for the user in one transaction, as new_game
+        does for one: the games and the user's seen words are put with one
+        batched put while their attempts are added to the given counter
+        shard, or a random one. Returns the games."""
+        user = yield userKey.get_async()
+        seen = WordFilter(user.seen_words if user else None)
+        games = [cls.create(userKey, user_name, difficulty, seen)
+                 for _ in range(count)]
+        entities = list(games)
+        if user:
+            user.seen_words = seen.to_bytes()
+            entities.append(user)
+        yield ndb.put_multi_async(entities) + [
+            AttemptsRemainingShard.add_async(
+                sum(game.attempts_remaining for game in games), shard)]
+        raise ndb.Return(games)
+
+    @classmethod
+    def create(cls, userKey, user_name=None, difficulty=None, seen=None):
+        """Returns a new game, not yet stored. Games are children of their
+        User, so a user's games are read with a strongly consistent ancestor
+        query and a game ends within its user's entity group. The word is
+        of the given difficulty, if any, and avoids the words of the
+        WordFilter seen, to which it is added."""
+        word = get_dictionary().choose(difficulty, seen=seen)
+        if seen is not None:
+            seen.add(word)
+        return Game(parent=userKey,
+                    user=userKey,
+                    user_name=user_name,
+                    target_word=word,
+                    word_mask=letter_mask(word.lower()),
+                    guessed=0,
+                    attempts_allowed=GUESSES_ALLOWED,
+                    attempts_remaining=GUESSES_ALLOWED)
+
+    def _pre_put_hook(self):
+        self.version = (self.version or 0) + 1
+        if self.word_mask is None:
+            self.word_mask = self.target_mask
+        if self.guessed is None:
+            self.guessed = self.guessed_mask
+            self.legacy_word_state = None
+            self.legacy_past_guesses = []
+
+    @property
+    def guessed_mask(self):
+        """The mask of the letters guessed so far"""
+        if self.guessed is None:
+            return letter_mask(letter for letter in self.legacy_past_guesses
+                               if letter in ALPHABET)
+        return self.guessed
+
+    @property
+    def target_mask(self):
+        """The mask of the letters of the target word"""
+        if self.word_mask is None:
+            return letter_mask(self.target_word.lower())
+        return self.word_mask
+
+    @property
+    def word_state(self):
+        """The target word with the letters not yet guessed shown as '_'"""
+        # Words are ASCII, but come back from the datastore as unicode
+        return reveal(str(self.target_word.lower()), self.guessed_mask,
+                      self.target_mask)
+
+    def has_guessed(self, letter):
+        """True if the lowercase letter has already been guessed"""
+        return bool(self.guessed_mask & letter_bit(letter))
+
+    def add_guess(self, letter):
+        """Records a guess of the lowercase letter"""
+        self.guessed = self.guessed_mask | letter_bit(letter)
+
+    def has_legacy_history(self):
+        """True if this game's moves are stored as History children"""
+        return bool(self.guessed_mask) and not self.moves
+
+    def fold_legacy_history(self):
+        """Moves the History children of an older game into its moves, so
+        they are rewritten with the next put of the game. Returns the keys
+        of the History children, which the caller deletes in the
+        transaction that puts the game."""
+        if not self.has_legacy_history():
+            return []
+        history = History.query(ancestor=self.key).order(History.order).fetch()
+        self.moves = [Move(guess=move.guess, message=move.message)
+                      for move in history]
+        return [move.key for move in history]
+
+    def save_history(self, guess, message):
+        """Records the last made move. It is stored with the next put of the
+        game, so the move and the game state are written together."""
+        move = Move(guess=guess, message=message)
+        self.moves.append(move)
         return move
 
-    def to_form(self, message):
-        """Returns a GameForm representation of the Game"""
+    def to_form(self, message, user_name=None):
+        """Returns a GameForm representation of the Game. Pass user_name when
+        it is already known to avoid fetching the User."""
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.user_name = self.user.get().name
+        form.user_name = user_name or self.user_name or self.user.get().name
         form.attempts_remaining = self.attempts_remaining
         form.game_over = self.game_over
         form.word_state = self.word_state
         form.message = message
         return form
 
+    @ndb.transactional(xg=True)
     def end_game(self, won=False, score=0):
         """Ends the game - if won is True, the player won. - if won is False,
-        the player lost."""
-        self.game_over = True
-        self.put()
-        # Add the game to the score 'board'
-        score = Score(user=self.user, date=date.today(), won=won,
-                      guesses=self.attempts_allowed - self.attempts_remaining,
-                      points=score)
-        score.put()
+        the player lost. The game, its Score and the user's all-time, daily
+        and weekly ranking totals are committed together."""
+        ndb.put_multi(Game.finish_games([(self, won, score)]))
+
+    @staticmethod
+    def finish_games(results, forfeited=False):
+        """Marks games as over and records their Scores in the rankings of
+        their users, which are read with one batched get. results holds a
+        (game, won, points) tuple per game; forfeited marks the Scores of
+        abandoned games. Returns the games, Scores and rankings to put;
+        call it in the transaction that puts them. Each Score is offered to
+        the high score cache once the transaction commits."""
+        today = date.today()
+        now = datetime.now()
+        scores = []
+        for game, won, points in results:
+            game.game_over = True
+            game.ended_at = now
+            # Add the game to the score 'board'
+            scores.append(Score(
+                parent=game.user, user=game.user, date=today, won=won,
+                points=points, forfeited=forfeited,
+                guesses=game.attempts_allowed - game.attempts_remaining))
+        rankings = UserRanking.get_all_for_users(
+            set(score.user for score in scores), today)
+        for score in scores:
+            for ranking in rankings[score.user]:
+                ranking.record(score)
+            ndb.get_context().call_on_commit(functools.partial(
+                HighScoreCache.offer, score, rankings[score.user][0].user_name))
+        return ([game for game, _, _ in results] + scores +
+                [ranking for user_rankings in rankings.values()
+                 for ranking in user_rankings])
 
 
 class Score(ndb.Model):
-    """Score object"""
+    """Score object. Child of the User it belongs to."""
     user = ndb.KeyProperty(required=True, kind='User')
     date = ndb.DateProperty(required=True)
     won = ndb.BooleanProperty(required=True)
     guesses = ndb.IntegerProperty(required=True)
     points = ndb.IntegerProperty(required=True)
+    # True for games expired by the sweeper after being abandoned
+    forfeited = ndb.BooleanProperty(default=False, indexed=False)
 
-    def to_form(self):
-        return ScoreForm(user_name=self.user.get().name, won=self.won,
+    def to_form(self, user_name=None):
+        return ScoreForm(user_name=user_name or self.user.get().name,
+                         won=self.won, forfeited=bool(self.forfeited),
                          date=str(self.date), guesses=self.guesses,
                          points=self.points)
 
+
+class GameArchive(ndb.Model):
+    """A finished game packed into a single compressed blob, with no
+    indexed properties. Has the id and parent of the Game it replaces, so
+    it is found from the game's key with a get."""
+    data = ndb.BlobProperty(required=True, compressed=True)
+
+    @classmethod
+    def key_for(cls, game_key):
+        return ndb.Key(cls, game_key.id(), parent=game_key.parent())
+
+    @classmethod
+    def pack(cls, game):
+        """Returns the archive of a finished game. Fold the game's legacy
+        History into its moves first."""
+        return cls(key=cls.key_for(game.key), data=json.dumps({
+            'user': game.user.urlsafe(),
+            'user_name': game.user_name,
+            'target_word': game.target_word,
+            'guessed': game.guessed_mask,
+            'attempts_allowed': game.attempts_allowed,
+            'attempts_remaining': game.attempts_remaining,
+            'moves': [[move.guess, move.message] for move in game.moves],
+            'ended_at': game.ended_at and game.ended_at.isoformat()},
+            separators=(',', ':')))
+
+    def unpack(self, game_key):
+        """Returns the archived game as a finished Game with key game_key.
+        It is not meant to be put again."""
+        record = json.loads(self.data)
+        ended_at = record['ended_at']
+        return Game(key=game_key, user=ndb.Key(urlsafe=record['user']),
+                    user_name=record['user_name'],
+                    target_word=record['target_word'],
+                    guessed=record['guessed'],
+                    attempts_allowed=record['attempts_allowed'],
+                    attempts_remaining=record['attempts_remaining'],
+                    game_over=True,
+                    moves=[Move(guess=guess, message=message)
+                           for guess, message in record['moves']],
+                    ended_at=ended_at and datetime.strptime(
+                        ended_at[:19], '%Y-%m-%dT%H:%M:%S'))
+
+    @classmethod
+    def get_game(cls, game_key):
+        """Returns the archived game stored for game_key, or None"""
+        archive = cls.key_for(game_key).get()
+        return archive.unpack(game_key) if archive else None
+
+
+class MovedGame(ndb.Model):
+    """Left in place of a game that was moved under another parent, so the
+    urlsafe keys handed out for the old key keep working. Keyed by the flat
+    path of the old key."""
+    game = ndb.KeyProperty(required=True, kind='Game', indexed=False)
+
+    # Games may be moved under their legacy User, then under its name key
+    MAX_HOPS = 3
+
+    @classmethod
+    def key_for(cls, game_key):
+        return ndb.Key(cls, '/'.join(str(part) for part in game_key.flat()))
+
+    @classmethod
+    def resolve(cls, game_key):
+        """Returns the current key of the game stored under game_key. Only
+        keys of games that may have been moved cost a get."""
+        for _ in range(cls.MAX_HOPS):
+            parent = game_key.parent()
+            if parent and isinstance(parent.id(), basestring):
+                break
+            moved = cls.key_for(game_key).get()
+            if not moved:
+                break
+            game_key = moved.game
+        return game_key
+
+
+class UserRanking(ndb.Model):
+    """Running totals for a User's finished games. Child of the User so
+    there is exactly one per user; kept current by Game.end_game."""
+    user_name = ndb.StringProperty(required=True)
+    total_score = ndb.IntegerProperty(required=True, default=0)
+    wins = ndb.IntegerProperty(required=True, default=0)
+    games_played = ndb.IntegerProperty(required=True, default=0)
+
+    @classmethod
+    def key_for(cls, user_key):
+        """Returns the key of the ranking belonging to user_key"""
+        return ndb.Key(cls, 'totals', parent=user_key)
+
+    @classmethod
+    def get_all_for_users(cls, user_keys, day):
+        """Returns a dict mapping each user key to the user's all-time ranking
+        followed by the daily and weekly ones for day, all read with one
+        batched get. Missing rankings are returned new and empty."""
+        windows = (PeriodRanking.DAILY, PeriodRanking.WEEKLY)
+        keys = []
+        for user_key in user_keys:
+            keys.append(cls.key_for(user_key))
+            keys.extend(PeriodRanking.key_for(
+                user_key, PeriodRanking.period_name(window, day))
+                for window in windows)
+        found = ndb.get_multi(keys)
+        rankings = {}
+        step = len(windows) + 1
+        for i in range(0, len(keys), step):
+            user_key = keys[i].parent()
+            user_rankings = found[i:i + step]
+            names = [ranking.user_name for ranking in user_rankings if ranking]
+            user_name = names[0] if names else user_key.get().name
+            if not user_rankings[0]:
+                user_rankings[0] = cls(key=keys[i], user_name=user_name)
+            for j, window in enumerate(windows, 1):
+                if not user_rankings[j]:
+                    user_rankings[j] = PeriodRanking(
+                        key=keys[i + j], user_name=user_name,
+                        period=keys[i + j].id(),
+                        expires=day + PeriodRanking.RETENTION[window])
+            rankings[user_key] = user_rankings
+        return rankings
+
+    def record(self, score):
+        """Adds a finished game's Score to the totals"""
+        self.total_score += score.points
+        self.games_played += 1
+        if score.won:
+            self.wins += 1
+
+    def to_form(self):
+        return UserForm(user_name=self.user_name,
+                        total_score=self.total_score, wins=self.wins,
+                        games_played=self.games_played)
+
+
+class PeriodRanking(UserRanking):
+    """A User's totals for the games finished on one day or in one ISO week.
+    Child of the User, identified by its period such as 'day:2016-10-12' or
+    'week:2016-W41'. Expired periods are deleted by a cron job."""
+    period = ndb.StringProperty(required=True)
+    expires = ndb.DateProperty(required=True)
+
+    DAILY = 'daily'
+    WEEKLY = 'weekly'
+    # How long each kind of period is kept after the day it was created
+    RETENTION = {DAILY: timedelta(days=14), WEEKLY: timedelta(weeks=12)}
+
+    @classmethod
+    def key_for(cls, user_key, period):
+        return ndb.Key(cls, period, parent=user_key)
+
+    @staticmethod
+    def period_name(window, day):
+        """Returns the name of the daily or weekly period containing day"""
+        if window == PeriodRanking.DAILY:
+            return 'day:{}'.format(day.isoformat())
+        year, week, _ = day.isocalendar()
+        return 'week:{}-W{:02d}'.format(year, week)
+
+
+class AttemptsRemainingShard(ndb.Model):
+    """One shard of the total attempts remaining over all active games.
+    Writes go to a random shard so they rarely contend; reading the total
+    costs one batched get of NUM_SHARDS entities."""
+    count = ndb.IntegerProperty(required=True, default=0, indexed=False)
+
+    # At most 25 entity groups fit in a cross-group transaction, which
+    # bounds the shard count because reset writes all of them at once.
+    NUM_SHARDS = 20
+
+    @classmethod
+    def _keys(cls):
+        # Shard ids start at 1: a key with id 0 is incomplete
+        return [ndb.Key(cls, i) for i in range(1, cls.NUM_SHARDS + 1)]
+
+    @classmethod
+    def add(cls, delta):
+        """Adds delta to the total. Joins the caller's transaction, so call
+        it at most once per transaction."""
+        cls.add_async(delta).get_result()
+
+    @classmethod
+    def shard_ids(cls, count):
+        """Returns count shard ids, distinct while count is at most
+        NUM_SHARDS, for concurrent transactions to add to without
+        contending"""
+        ids = random.sample(range(1, cls.NUM_SHARDS + 1),
+                            min(count, cls.NUM_SHARDS))
+        return [ids[i % len(ids)] for i in range(count)] if ids else []
+
+    @classmethod
+    @ndb.transactional_tasklet(xg=True)
+    def add_async(cls, delta, shard=None):
+        """Adds delta to the given shard, or a random one"""
+        key = ndb.Key(cls, shard or random.randint(1, cls.NUM_SHARDS))
+        shard = (yield key.get_async()) or cls(key=key)
+        shard.count += delta
+        yield shard.put_async()
+
+    @classmethod
+    def total(cls):
+        """Returns the total attempts remaining over all active games"""
+        return sum(shard.count for shard in ndb.get_multi(cls._keys())
+                   if shard)
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def reset(cls, total):
+        """Replaces the total, e.g. with one recounted from the games"""
+        shards = [cls(key=key, count=0) for key in cls._keys()]
+        shards[0].count = total
+        ndb.put_multi(shards)
+
+
 class GameForm(messages.Message):
     """GameForm for outbound game state information"""
     urlsafe_key = messages.StringField(1, required=True)
@@ -106,11 +540,20 @@ class GameForm(messages.Message):
 class GameForms(messages.Message):
     """Return multiple GameForms"""
     items = messages.MessageField(GameForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class NewGameForm(messages.Message):
     """Used to create a new game"""
     user_name = messages.StringField(1, required=True)
+    difficulty = messages.StringField(2)
+
+
+class NewGamesForm(messages.Message):
+    """Used to create several games for one or more users"""
+    user_names = messages.StringField(1, repeated=True)
+    games_per_user = messages.IntegerField(2, default=1)
+    difficulty = messages.StringField(3)
 
 
 class GuessForm(messages.Message):
@@ -118,6 +561,30 @@ class GuessForm(messages.Message):
     guess = messages.StringField(1, required=True)
 
 
+class BatchGuessForm(messages.Message):
+    """A guess in one of the games of a GuessesForm"""
+    urlsafe_game_key = messages.StringField(1, required=True)
+    guess = messages.StringField(2, required=True)
+
+
+class GuessesForm(messages.Message):
+    """Used to make guesses in several games at once"""
+    items = messages.MessageField(BatchGuessForm, 1, repeated=True)
+
+
+class BatchResultForm(messages.Message):
+    """Outcome of one item of a batch request: the resulting game state, or
+    an error and what it was about"""
+    game = messages.MessageField(GameForm, 1)
+    error = messages.StringField(2)
+    item = messages.StringField(3)
+
+
+class BatchResultForms(messages.Message):
+    """Returns the outcomes of a batch request in request order"""
+    items = messages.MessageField(BatchResultForm, 1, repeated=True)
+
+
 class ScoreForm(messages.Message):
     """ScoreForm for outbound Score information"""
     user_name = messages.StringField(1, required=True)
@@ -125,11 +592,13 @@ class ScoreForm(messages.Message):
     won = messages.BooleanField(3, required=True)
     guesses = messages.IntegerField(4, required=True)
     points = messages.IntegerField(5, required=True)
+    forfeited = messages.BooleanField(6)
 
 
 class ScoreForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class HighScoresForm(messages.Message):
@@ -141,10 +610,13 @@ class UserForm(messages.Message):
     """User Form for outbound User information"""
     user_name = messages.StringField(1, required=True)
     total_score = messages.IntegerField(2, required=True)
+    wins = messages.IntegerField(3)
+    games_played = messages.IntegerField(4)
 
 
 class History(ndb.Model):
-    """Object representing a past guess and result"""
+    """Object representing a past guess and result. Only games created before
+    moves were stored on the Game itself have these."""
     guess = ndb.StringProperty(required=True)
     message = ndb.StringProperty(required=True)
     order = ndb.IntegerProperty(required=True)
@@ -165,11 +637,19 @@ class HistoryForm(messages.Message):
 class HistoryForms(messages.Message):
     """Returns multiple HistoryForms"""
     items = messages.MessageField(HistoryForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class UserForms(messages.Message):
     """Container for multiple User Forms"""
     items = messages.MessageField(UserForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
+
+
+class PageForm(messages.Message):
+    """Used to request one page of a listing"""
+    page_size = messages.IntegerField(1, default=20)
+    cursor = messages.StringField(2)
 
 
 class StringMessage(messages.Message):
@@ -0,0 +1,135 @@
+"""reminders.py - Fan-out pipeline for the reminder emails sent by the cron
+jobs. A scan task walks the recipients one page at a time and enqueues send
+tasks for them, which the mail queue runs in parallel. Each scan task
+enqueues the next one with the query cursor, so a run resumes where it left
+off if a task is retried."""
+
+import logging
+import time
+
+from google.appengine.api import app_identity, mail, memcache, taskqueue
+from google.appengine.ext import ndb
+
+import runs
+from models import User, Game
+
+QUEUE_NAME = 'mail'
+SCAN_URL = '/tasks/reminders/scan'
+SEND_URL = '/tasks/reminders/send'
+SCAN_BATCH_SIZE = 500
+SEND_BATCH_SIZE = 50
+# A cron request retried within this many seconds joins the run it started
+# instead of starting another. Shorter than the hourly paused reminder.
+RUN_DEDUPE_TIME = 30 * 60
+
+REMINDER = 'reminder'
+PAUSED = 'paused'
+
+
+def start_run(kind):
+    """Starts a reminder run of the given kind and returns its id. If a run
+    of that kind started less than RUN_DEDUPE_TIME ago, returns its id
+    instead, so a retried cron request does not mail everyone twice."""
+    run_id = '{}-{}'.format(kind, int(time.time()))
+    if not memcache.add('Reminders:active:{}'.format(kind), run_id,
+                        time=RUN_DEDUPE_TIME):
+        active = memcache.get('Reminders:active:{}'.format(kind))
+        if active:
+            logging.info('Reminder run %s already started', active)
+            return active
+    RunStats(run_id).start()
+    runs.enqueue(QUEUE_NAME, [_scan_task(run_id, kind, 0, None)])
+    return run_id
+
+
+def scan(run_id, kind, page, cursor):
+    """Reads one page of recipients and enqueues the send tasks for it,
+    followed by the scan of the next page."""
+    if kind == PAUSED:
+        # One result per user with active games, read from the
+        # Game(game_over, user) index without loading any game.
+        query = Game.query(Game.game_over == False, projection=[Game.user],
+                           distinct=True).order(Game.user)
+        games, next_cursor, more = query.fetch_page(SCAN_BATCH_SIZE,
+                                                    start_cursor=cursor)
+        user_keys = [game.user for game in games]
+    else:
+        query = User.query(User.email > None)
+        user_keys, next_cursor, more = query.fetch_page(
+            SCAN_BATCH_SIZE, keys_only=True, start_cursor=cursor)
+
+    tasks = []
+    for i in range(0, len(user_keys), SEND_BATCH_SIZE):
+        tasks.append(_send_task(run_id, kind, page, i / SEND_BATCH_SIZE,
+                                user_keys[i:i + SEND_BATCH_SIZE]))
+    if more and next_cursor:
+        tasks.append(_scan_task(run_id, kind, page + 1, next_cursor))
+    runs.enqueue(QUEUE_NAME, tasks)
+    RunStats(run_id).incr('scanned', len(user_keys))
+    if not more:
+        RunStats(run_id).finish_scan()
+
+
+def send(run_id, kind, user_keys):
+    """Sends the reminder to each of the users"""
+    sender = 'noreply@{}.appspotmail.com'.format(
+        app_identity.get_application_id())
+    sent = failed = 0
+    for user in ndb.get_multi(user_keys):
+        if not user or not user.email:
+            continue
+        if kind == PAUSED:
+            subject = 'Paused match reminder!'
+            body = 'Hello {}, \n\nYou have games in ' \
+                   'progress:\n'.format(user.name)
+        else:
+            subject = 'This is a reminder!'
+            body = 'Hello {}, try out Hangman!'.format(user.name)
+        try:
+            mail.send_mail(sender, user.email, subject, body)
+            sent += 1
+        except mail.Error:
+            logging.exception('Could not send reminder to %s', user.email)
+            failed += 1
+    stats = RunStats(run_id)
+    stats.incr('sent', sent)
+    stats.incr('failed', failed)
+
+
+def _scan_task(run_id, kind, page, cursor):
+    params = {'run_id': run_id, 'kind': kind, 'page': page}
+    if cursor:
+        params['cursor'] = cursor.urlsafe()
+    return taskqueue.Task(url=SCAN_URL, params=params,
+                          name='{}-scan-{}'.format(run_id, page))
+
+
+def _send_task(run_id, kind, page, batch, user_keys):
+    return taskqueue.Task(
+        url=SEND_URL,
+        params={'run_id': run_id, 'kind': kind,
+                'users': ','.join(key.urlsafe() for key in user_keys)},
+        name='{}-send-{}-{}'.format(run_id, page, batch))
+
+
+class RunStats(runs.RunStats):
+    """Throughput counters for one reminder run, kept in memcache"""
+    PREFIX = 'Reminders'
+    COUNTERS = ('scanned', 'sent', 'failed')
+    FIELDS = ('started', 'scan_finished', 'updated')
+
+    def finish_scan(self):
+        self.mark('scan_finished')
+
+    def incr(self, name, delta=1):
+        if delta:
+            super(RunStats, self).incr(name, delta)
+            self.mark('updated')
+
+    def summary(self):
+        """Returns the run's counters and mails sent per second"""
+        summary = super(RunStats, self).summary()
+        elapsed = (summary['updated'] or 0) - (summary['started'] or 0)
+        summary['sent_per_second'] = (summary['sent'] / elapsed
+                                      if elapsed > 0 else None)
+        return summary
@@ -0,0 +1,75 @@
+"""runs.py - Plumbing shared by the task-driven background runs, the reminder
+fan-out (reminders.py) and the stale game sweep (sweeper.py): adding named
+tasks, and the per-run counters kept in memcache for the /admin/stats
+pages."""
+
+import time
+
+from google.appengine.api import memcache, taskqueue
+
+
+def enqueue(queue_name, tasks):
+    """Adds the tasks to the queue in batches. Tasks are named, so a retried
+    task does not enqueue the same follow-up tasks twice."""
+    queue = taskqueue.Queue(queue_name)
+    for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+        try:
+            queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+
+
+class RunStats(object):
+    """Counters for one run, kept in memcache under PREFIX. Subclasses name
+    the COUNTERS they increment and the other FIELDS, such as timestamps,
+    their summary reports."""
+    PREFIX = None
+    COUNTERS = ()
+    FIELDS = ('started',)
+    # Number of runs whose counters are listed by recent()
+    RECENT_RUNS = 10
+
+    def __init__(self, run_id):
+        self.run_id = run_id
+
+    def _key(self, name):
+        return '{}:{}:{}'.format(self.PREFIX, self.run_id, name)
+
+    @classmethod
+    def _runs_key(cls):
+        return cls.PREFIX + ':runs'
+
+    def start(self, **fields):
+        """Records the start of the run, with the given fields"""
+        fields['started'] = time.time()
+        memcache.set_multi(dict((self._key(name), value)
+                                for name, value in fields.items()))
+        runs = memcache.get(self._runs_key()) or []
+        memcache.set(self._runs_key(),
+                     ([self.run_id] + runs)[:self.RECENT_RUNS])
+
+    def mark(self, name):
+        """Sets the field name to the current time"""
+        memcache.set(self._key(name), time.time())
+
+    def incr(self, name, delta=1):
+        """Adds delta to the counter name and returns the new value"""
+        if delta:
+            return memcache.incr(self._key(name), delta, initial_value=0)
+
+    def summary(self):
+        """Returns the run's counters and fields"""
+        names = self.COUNTERS + self.FIELDS
+        values = memcache.get_multi([self._key(name) for name in names])
+        summary = dict((name, values.get(self._key(name))) for name in names)
+        for name in self.COUNTERS:
+            summary[name] = summary[name] or 0
+        summary['run_id'] = self.run_id
+        return summary
+
+    @classmethod
+    def recent(cls):
+        """Returns the summaries of the most recent runs, newest first"""
+        return [cls(run_id).summary()
+                for run_id in memcache.get(cls._runs_key()) or []]
@@ -0,0 +1,156 @@
+"""sweeper.py - Expires abandoned games. A run splits the games idle for
+longer than IDLE_TIME into SHARDS ranges of Game.updated_at and sweeps the
+ranges in parallel tasks. Each shard walks its range with a keys-only query
+on the Game(game_over, updated_at) index, so a run only reads stale games,
+and forfeits them in transactions that record a Score and take their
+attempts off the counter. Each sweep task enqueues the next one with the
+query cursor, so a shard resumes where it left off if a task is retried."""
+
+import calendar
+import logging
+import time
+from datetime import datetime, timedelta
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import runs
+from cache import GameCache
+from models import Game, AttemptsRemainingShard
+
+QUEUE_NAME = 'sweep'
+SWEEP_URL = '/tasks/sweep'
+IDLE_TIME = timedelta(days=7)
+SHARDS = 8
+SWEEP_BATCH_SIZE = 100
+# A forfeited game touches its own entity group and its user's, and the
+# attempts counter takes one more, within the 25 a transaction may span.
+FORFEIT_TRANSACTION_GAMES = 12
+
+
+def start_run(legacy=False):
+    """Starts a sweep and returns its id. A legacy run instead walks all
+    active games in a single shard and forfeits the ones not put since
+    updated_at was added; run it once, at least IDLE_TIME after deploying
+    updated_at."""
+    run_id = 'sweep-{}'.format(int(time.time()))
+    cutoff = datetime.now() - IDLE_TIME
+    if legacy:
+        bounds = [None]
+    else:
+        oldest = Game.query(Game.game_over == False,
+                            Game.updated_at < cutoff).order(
+            Game.updated_at).get(projection=[Game.updated_at])
+        bounds = _split(oldest.updated_at, cutoff) if oldest else []
+    SweepStats(run_id).start(len(bounds))
+    runs.enqueue(QUEUE_NAME, [
+        _sweep_task(run_id, shard, bounds[shard], 0, None)
+        for shard in range(len(bounds))])
+    return run_id
+
+
+def sweep(run_id, shard, bounds, page, cursor):
+    """Forfeits one page of the stale games of a shard, then enqueues the
+    sweep of the next page. bounds is the shard's (start, end) range of
+    updated_at, or None for a legacy run."""
+    if bounds:
+        start, end = bounds
+        query = Game.query(Game.game_over == False, Game.updated_at >= start,
+                           Game.updated_at < end)
+    else:
+        end = None
+        query = Game.query(Game.game_over == False).order(Game.key)
+    game_keys, next_cursor, more = query.fetch_page(
+        SWEEP_BATCH_SIZE, keys_only=True, start_cursor=cursor)
+    forfeited = 0
+    for i in range(0, len(game_keys), FORFEIT_TRANSACTION_GAMES):
+        games = _forfeit(game_keys[i:i + FORFEIT_TRANSACTION_GAMES], end)
+        GameCache.set_multi(games)
+        forfeited += len(games)
+    stats = SweepStats(run_id)
+    stats.incr('scanned', len(game_keys))
+    stats.incr('forfeited', forfeited)
+    if more and next_cursor:
+        runs.enqueue(QUEUE_NAME, [_sweep_task(run_id, shard, bounds,
+                                              page + 1, next_cursor)])
+    else:
+        stats.finish_shard()
+
+
+@ndb.transactional(xg=True)
+def _forfeit(game_keys, idle_before):
+    """Ends the games still active and last put before idle_before, or
+    never put since updated_at was added if idle_before is None, with a
+    forfeited Score of 0 points. Returns the forfeited games."""
+    games = [game for game in ndb.get_multi(game_keys)
+             if game and not game.game_over and
+             (game.updated_at < idle_before if idle_before
+              else game.updated_at is None)]
+    if not games:
+        return []
+    attempts = sum(game.attempts_remaining for game in games)
+    entities = Game.finish_games([(game, False, 0) for game in games],
+                                 forfeited=True)
+    ndb.Future.wait_all(ndb.put_multi_async(entities) +
+                        [AttemptsRemainingShard.add_async(-attempts)])
+    return games
+
+
+def _split(start, end):
+    """Splits [start, end) into SHARDS ranges of equal length"""
+    step = (end - start) / SHARDS
+    bounds = [start + step * i for i in range(SHARDS)] + [end]
+    return [(bounds[i], bounds[i + 1]) for i in range(SHARDS)
+            if bounds[i] < bounds[i + 1]]
+
+
+def _timestamp(value):
+    return calendar.timegm(value.timetuple()) * 1000000 + value.microsecond
+
+
+def _datetime(timestamp):
+    return datetime.utcfromtimestamp(0) + timedelta(microseconds=timestamp)
+
+
+def parse_bounds(start, end):
+    """Returns the bounds of a shard from the task parameters"""
+    if not start:
+        return None
+    return _datetime(int(start)), _datetime(int(end))
+
+
+def _sweep_task(run_id, shard, bounds, page, cursor):
+    params = {'run_id': run_id, 'shard': shard, 'page': page}
+    if bounds:
+        params['start'] = _timestamp(bounds[0])
+        params['end'] = _timestamp(bounds[1])
+    if cursor:
+        params['cursor'] = cursor.urlsafe()
+    return taskqueue.Task(url=SWEEP_URL, params=params,
+                          name='{}-{}-{}'.format(run_id, shard, page))
+
+
+class SweepStats(runs.RunStats):
+    """Counters for one sweep run, kept in memcache"""
+    PREFIX = 'Sweeps'
+    COUNTERS = ('scanned', 'forfeited', 'shards_done')
+    FIELDS = ('shards', 'started', 'finished')
+
+    def start(self, shards):
+        super(SweepStats, self).start(shards=shards)
+        if not shards:
+            self.mark('finished')
+
+    def finish_shard(self):
+        done = self.incr('shards_done')
+        if done is not None and done >= self.summary()['shards']:
+            self.mark('finished')
+            logging.info('Sweep %s done: %s', self.run_id, self.summary())
+
+    def summary(self):
+        """Returns the run's counters and how long it took"""
+        summary = super(SweepStats, self).summary()
+        summary['seconds'] = (summary['finished'] - summary['started']
+                              if summary['finished'] and summary['started']
+                              else None)
+        return summary
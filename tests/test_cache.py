@@ -0,0 +1,314 @@
+"""test_cache.py - Tests of the caches and the rate limiter against the App
+Engine stubs, with the clock of cache.py replaced so refills, expiry and
+waits take no time. Needs the App Engine SDK, see benchmarks/testbed.py:
+
+    python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                'benchmarks'))
+import testbed
+testbed.setup_sdk()
+
+import json
+
+import webob
+from google.appengine.api import memcache
+
+import api
+import cache
+import metrics
+from cache import GameCache, HighScoreCache, RateLimiter, ResponseCache
+from models import Game, User
+
+
+class FakeClock(object):
+    """Stands in for the time module in cache.py. on_sleep, if set, is
+    called after each sleep, e.g. to act as a concurrent request."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.on_sleep = None
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        if self.on_sleep:
+            self.on_sleep()
+
+
+class CacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.bed = testbed.activate()
+        self.clock = FakeClock()
+        self.real_time = cache.time
+        cache.time = self.clock
+        self.real_client = memcache.Client
+        self.counters = metrics.counters()
+
+    def tearDown(self):
+        cache.time = self.real_time
+        cache.memcache.Client = self.real_client
+        self.bed.deactivate()
+
+    def counted(self, name):
+        """Returns how many times the metrics event name was counted during
+        the test"""
+        return metrics.counters().get(name, 0) - self.counters.get(name, 0)
+
+
+class RateLimiterTest(CacheTestCase):
+
+    def take(self, client_id, requests):
+        """Returns how many of requests made at once are allowed"""
+        return sum(RateLimiter.allow(client_id) for _ in range(requests))
+
+    def test_burst(self):
+        self.assertEqual(self.take('ip:1', RateLimiter.BURST + 5),
+                         RateLimiter.BURST)
+        self.assertEqual(self.counted('RateLimiter.limited'), 5)
+        # Other clients have their own bucket
+        self.assertTrue(RateLimiter.allow('ip:2'))
+
+    def test_refill(self):
+        self.take('ip:1', RateLimiter.BURST)
+        self.assertFalse(RateLimiter.allow('ip:1'))
+        self.clock.now += 1
+        self.assertEqual(self.take('ip:1', RateLimiter.BURST),
+                         int(RateLimiter.RATE))
+        # A bucket never holds more than BURST tokens
+        self.clock.now += 3600
+        self.assertEqual(self.take('ip:1', RateLimiter.BURST + 5),
+                         RateLimiter.BURST)
+
+    def test_concurrent_take(self):
+        RateLimiter.allow('ip:1')
+        real_client = self.real_client
+
+        class InterleavedClient(real_client):
+            """Lets another request take a token between the first gets
+            and cas"""
+            interleaved = False
+
+            def gets(self, key):
+                bucket = real_client.gets(self, key)
+                if not InterleavedClient.interleaved:
+                    InterleavedClient.interleaved = True
+                    RateLimiter.allow('ip:1')
+                return bucket
+
+        cache.memcache.Client = InterleavedClient
+        self.assertTrue(RateLimiter.allow('ip:1'))
+        tokens, _ = memcache.get(RateLimiter.PREFIX + 'ip:1')
+        self.assertEqual(tokens, RateLimiter.BURST - 3)
+        self.assertEqual(self.counted('RateLimiter.allowed'), 3)
+
+    def test_contended_lets_through(self):
+        self.take('ip:1', RateLimiter.BURST)
+
+        class ContendedClient(self.real_client):
+            def cas(self, *args, **kwargs):
+                return False
+
+        cache.memcache.Client = ContendedClient
+        self.clock.now += 1
+        self.assertTrue(RateLimiter.allow('ip:1'))
+        self.assertEqual(self.counted('RateLimiter.contended'), 1)
+
+    def test_disabled(self):
+        RateLimiter.ENABLED = False
+        try:
+            self.assertEqual(self.take('ip:1', RateLimiter.BURST + 5),
+                             RateLimiter.BURST + 5)
+        finally:
+            RateLimiter.ENABLED = True
+
+    def test_rate_limited_endpoint(self):
+        def call():
+            """Calls get_high_scores through the endpoints API server"""
+            request = webob.Request.blank(
+                '/_ah/spi/HangmanApi.get_high_scores', method='POST',
+                body='{}', content_type='application/json',
+                remote_addr='10.0.0.1',
+                headers={'X-Appengine-Peer': 'apiserving'})
+            return request.get_response(api.api)
+        for _ in range(RateLimiter.BURST):
+            self.assertEqual(call().status_int, 200)
+        response = call()
+        self.assertEqual(response.status_int, 403)
+        self.assertIn('retry', json.loads(response.body)['error_message'])
+
+
+class ResponseCacheTest(CacheTestCase):
+    TTL = 10
+
+    def setUp(self):
+        super(ResponseCacheTest, self).setUp()
+        self.computed = 0
+
+    def compute(self):
+        self.computed += 1
+        return 'response {}'.format(self.computed)
+
+    def get(self):
+        return ResponseCache.get('key', self.TTL, self.compute)
+
+    def hold_lock(self):
+        """Acts as another request refreshing the key"""
+        memcache.add(ResponseCache.LOCK_PREFIX + 'key', 1)
+
+    def test_fresh(self):
+        self.assertEqual(self.get(), 'response 1')
+        self.clock.now += self.TTL - 1
+        self.assertEqual(self.get(), 'response 1')
+        self.assertEqual(self.computed, 1)
+        self.assertEqual(self.counted('ResponseCache.fresh'), 1)
+
+    def test_expired(self):
+        self.get()
+        self.clock.now += self.TTL + 1
+        self.assertEqual(self.get(), 'response 2')
+        self.assertEqual(self.counted('ResponseCache.computed'), 2)
+
+    def test_stale_while_refreshing(self):
+        self.get()
+        self.clock.now += self.TTL + 1
+        self.hold_lock()
+        self.assertEqual(self.get(), 'response 1')
+        self.assertEqual(self.computed, 1)
+        self.assertEqual(self.counted('ResponseCache.stale'), 1)
+
+    def test_single_flight(self):
+        self.hold_lock()
+
+        def other_request_done():
+            memcache.set(ResponseCache.PREFIX + 'key',
+                         (self.clock.now + self.TTL, 'theirs'))
+        self.clock.on_sleep = other_request_done
+        self.assertEqual(self.get(), 'theirs')
+        self.assertEqual(self.computed, 0)
+        self.assertEqual(self.counted('ResponseCache.waited'), 1)
+
+    def test_uncoalesced(self):
+        self.hold_lock()
+        self.assertEqual(self.get(), 'response 1')
+        self.assertAlmostEqual(self.clock.now, 1000.0 + ResponseCache.WAITS *
+                               ResponseCache.WAIT_TIME)
+        self.assertEqual(self.counted('ResponseCache.uncoalesced'), 1)
+
+    def test_invalidate(self):
+        self.get()
+        ResponseCache.invalidate('key')
+        self.assertEqual(self.get(), 'response 2')
+
+    def test_lock_released_on_error(self):
+        def fail():
+            raise ValueError()
+        self.assertRaises(ValueError, ResponseCache.get, 'key', self.TTL,
+                          fail)
+        self.assertEqual(self.get(), 'response 1')
+
+
+class GameCacheTest(CacheTestCase):
+
+    def setUp(self):
+        super(GameCacheTest, self).setUp()
+        user_key = User(key=User.key_for('a'), name='a').put()
+        self.game = Game.new_game(user_key, 'a')
+        self.cache_key = GameCache.PREFIX + self.game.key.urlsafe()
+
+    def hold_lock(self):
+        """Acts as another request reading the game"""
+        memcache.add(GameCache.LOCK_PREFIX + self.game.key.urlsafe(), 1)
+
+    def test_read_through(self):
+        self.assertEqual(GameCache.get(self.game.key), self.game)
+        self.assertEqual(GameCache.get(self.game.key), self.game)
+        self.assertEqual(self.counted('GameCache.misses'), 1)
+        self.assertEqual(self.counted('GameCache.hits'), 1)
+
+    def test_single_flight(self):
+        self.hold_lock()
+
+        def other_request_done():
+            memcache.add(self.cache_key, self.game)
+        self.clock.on_sleep = other_request_done
+        self.game.key.delete()
+        # Served what the other request read, without reading it again
+        self.assertEqual(GameCache.get(self.game.key), self.game)
+        self.assertEqual(self.counted('GameCache.waited'), 1)
+
+    def test_uncoalesced(self):
+        self.hold_lock()
+        self.assertEqual(GameCache.get(self.game.key), self.game)
+        self.assertEqual(self.counted('GameCache.uncoalesced'), 1)
+
+    def test_invalidate(self):
+        GameCache.invalidate(self.game.key)
+        self.assertIsNone(GameCache.get(self.game.key))
+
+
+class HighScoreCacheTest(CacheTestCase):
+
+    def setUp(self):
+        super(HighScoreCacheTest, self).setUp()
+        HighScoreCache._local = None
+        self.loaded = 0
+
+    def load(self, number_of_results):
+        self.loaded += 1
+        return [(self.loaded, '2016-01-01', 'a', True, 1, False, None)]
+
+    def get(self):
+        return HighScoreCache.get(10, self.load)
+
+    def hold_lock(self):
+        """Acts as another request rebuilding the cache"""
+        memcache.add(HighScoreCache.REBUILD_LOCK, 1)
+
+    def test_rebuild(self):
+        self.assertEqual(self.get()[0][0], 1)
+        self.clock.now += HighScoreCache.LOCAL_TIME + 1
+        self.assertEqual(self.get()[0][0], 1)
+        self.assertEqual(self.loaded, 1)
+
+    def test_stale_while_rebuilding(self):
+        self.get()
+        memcache.delete(HighScoreCache.KEY)
+        self.clock.now += HighScoreCache.LOCAL_TIME + 1
+        self.hold_lock()
+        self.assertEqual(self.get()[0][0], 1)
+        self.assertEqual(self.loaded, 1)
+        self.assertEqual(self.counted('HighScoreCache.stale'), 1)
+
+    def test_single_flight(self):
+        self.hold_lock()
+
+        def other_request_done():
+            memcache.set(HighScoreCache.KEY, self.load(HighScoreCache.K))
+        self.clock.on_sleep = other_request_done
+        self.assertEqual(self.get()[0][0], 1)
+        self.assertEqual(self.loaded, 1)
+        self.assertEqual(self.counted('HighScoreCache.waited'), 1)
+
+    def test_uncoalesced(self):
+        self.hold_lock()
+        self.assertIsNone(self.get())
+        self.assertEqual(self.counted('HighScoreCache.uncoalesced'), 1)
+
+    def test_lock_released_on_error(self):
+        def fail(number_of_results):
+            raise ValueError()
+        self.assertRaises(ValueError, HighScoreCache.get, 10, fail)
+        self.assertEqual(self.get()[0][0], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+"""test_reminders.py - Runs the reminder crons end to end against the App
+Engine stubs: the queued scan and send tasks are posted to the app until the
+mail queue is empty, and the test checks who was mailed. Needs the App
+Engine SDK, see benchmarks/testbed.py:
+
+    python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                'benchmarks'))
+import testbed
+testbed.setup_sdk()
+
+import webapp2
+
+import main
+import reminders
+from models import Game, User
+
+
+class RemindersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bed = testbed.activate()
+        self.taskqueue = self.bed.get_stub('taskqueue')
+        self.mail = self.bed.get_stub('mail')
+        self.batch_sizes = reminders.SCAN_BATCH_SIZE, reminders.SEND_BATCH_SIZE
+        self.user('playing', 'playing@example.com', active=2, finished=1)
+        self.user('finished', 'finished@example.com', finished=1)
+        self.user('idle', 'idle@example.com')
+        self.user('no_email', None, active=1)
+
+    def tearDown(self):
+        reminders.SCAN_BATCH_SIZE, reminders.SEND_BATCH_SIZE = self.batch_sizes
+        self.bed.deactivate()
+
+    def user(self, name, email, active=0, finished=0):
+        user_key = User(key=User.key_for(name), name=name, email=email).put()
+        for i in range(active + finished):
+            game = Game.new_game(user_key, name)
+            if i >= active:
+                game.game_over = True
+                game.put()
+
+    def run_tasks(self):
+        """Posts the queued reminder tasks to the app until none are left"""
+        while True:
+            tasks = self.taskqueue.get_filtered_tasks(
+                queue_names=[reminders.QUEUE_NAME])
+            if not tasks:
+                return
+            for task in tasks:
+                self.taskqueue.DeleteTask(reminders.QUEUE_NAME, task.name)
+                request = webapp2.Request.blank(
+                    task.url, POST=task.payload,
+                    headers={'Content-Type':
+                             'application/x-www-form-urlencoded'})
+                self.assertEqual(request.get_response(main.app).status_int,
+                                 200)
+
+    def recipients(self, url):
+        self.assertEqual(webapp2.Request.blank(url).get_response(
+            main.app).status_int, 200)
+        self.run_tasks()
+        return sorted(message.to for message in self.mail.get_sent_messages())
+
+    def test_reminder(self):
+        self.assertEqual(self.recipients('/crons/send_reminder'),
+                         ['finished@example.com', 'idle@example.com',
+                          'playing@example.com'])
+
+    def test_paused(self):
+        self.assertEqual(self.recipients('/crons/send_Paused_Game_Reminder'),
+                         ['playing@example.com'])
+
+    def test_pages(self):
+        reminders.SCAN_BATCH_SIZE = reminders.SEND_BATCH_SIZE = 1
+        self.user('also_playing', 'also_playing@example.com', active=2)
+        self.assertEqual(self.recipients('/crons/send_Paused_Game_Reminder'),
+                         ['also_playing@example.com', 'playing@example.com'])
+        run = reminders.RunStats.recent()[0]
+        self.assertEqual(run['sent'], 2)
+        self.assertTrue(run['scan_finished'])
+
+
+if __name__ == '__main__':
+    unittest.main()
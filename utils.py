@@ -1,23 +1,55 @@
 """utils.py - File for collecting general utility functions."""
 
+import functools
 import logging
 from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
 import endpoints
 
+from cache import RateLimiter
 
-def get_by_urlsafe(urlsafe, model):
-    """Returns an ndb.Model entity that the urlsafe key points to. Checks
-        that the type of entity returned is of the correct kind. Raises an
-        error if the key String is malformed or the entity is of the incorrect
-        kind
+MAX_PAGE_SIZE = 100
+
+
+class TooManyRequestsException(endpoints.ForbiddenException):
+    """Raised when a client is over its request rate. Endpoints only maps
+    the errors of its own exception classes to their status, and none of
+    them is a 429, so clients get a 403 with a message to retry."""
+
+
+def rate_limited(func):
+    """Decorates an endpoints method so each client is held to the
+    RateLimiter rate. Clients are told apart by the user_name of the
+    request when it has one, otherwise by their IP address. Requests from
+    neither, such as calls made outside a request, are not limited."""
+    @functools.wraps(func)
+    def wrapper(self, request):
+        user_name = getattr(request, 'user_name', None)
+        request_state = getattr(self, 'request_state', None)
+        if user_name:
+            client_id = 'user:' + user_name.strip().lower()
+        elif request_state and request_state.remote_address:
+            client_id = 'ip:' + request_state.remote_address
+        else:
+            return func(self, request)
+        if not RateLimiter.allow(client_id):
+            raise TooManyRequestsException(
+                'Too many requests, please retry in a second.')
+        return func(self, request)
+    return wrapper
+
+
+def get_key_by_urlsafe(urlsafe, model):
+    """Returns the ndb.Key that the urlsafe key string points to, without
+        fetching the entity. Checks that the key is of the correct kind.
     Args:
         urlsafe: A urlsafe key string
         model: The expected entity kind
     Returns:
-        The entity that the urlsafe Key string points to or None if no entity
-        exists.
+        The ndb.Key the urlsafe Key string encodes.
     Raises:
-        ValueError:"""
+        BadRequestException: if the key String is malformed or of the
+        incorrect kind"""
     try:
         key = ndb.Key(urlsafe=urlsafe)
     except TypeError:
@@ -27,10 +59,64 @@ def get_by_urlsafe(urlsafe, model):
             raise endpoints.BadRequestException('Invalid Key')
         else:
             raise
+    if key.kind() != model._get_kind():
+        raise endpoints.BadRequestException('Incorrect Kind')
+    return key
+
 
-    entity = key.get()
-    if not entity:
+def get_cursor(urlsafe):
+    """Returns the datastore Cursor for a urlsafe cursor string, or None to
+    start from the beginning. Raises BadRequestException if the string is
+    not a valid cursor."""
+    if not urlsafe:
         return None
-    if not isinstance(entity, model):
-        raise endpoints.BadRequestException('Incorrect Kind')
-    return entity
+    try:
+        return Cursor(urlsafe=urlsafe)
+    except Exception:
+        raise endpoints.BadRequestException('Invalid Cursor')
+
+
+def get_user_names(user_keys):
+    """Resolves User keys to names with a single batched get.
+    Args:
+        user_keys: An iterable of User keys, duplicates allowed
+    Returns:
+        A dict mapping each User key to its name. Keys of deleted users are
+        left out."""
+    keys = list(set(user_keys))
+    return dict((key, user.name)
+                for key, user in zip(keys, ndb.get_multi(keys)) if user)
+
+
+def fetch_page(query, page_size, cursor, keys_only=False):
+    """Fetches one page of a query's results.
+    Args:
+        query: The ndb.Query to page through
+        page_size: Number of results wanted, at most MAX_PAGE_SIZE
+        cursor: urlsafe cursor returned with the previous page, or None
+        keys_only: Fetch the keys of the results instead of the entities
+    Returns:
+        A (results, next_cursor) tuple where next_cursor is the urlsafe
+        cursor of the following page, or None if this is the last page.
+    Raises:
+        BadRequestException: if page_size or cursor is invalid"""
+    return fetch_page_async(query, page_size, cursor,
+                            keys_only).get_result()
+
+
+def fetch_page_async(query, page_size, cursor, keys_only=False):
+    """Like fetch_page, but returns a Future of the (results, next_cursor)
+    tuple. page_size and cursor are checked before the query starts, so
+    BadRequestException is raised right away."""
+    if not page_size or not 0 < page_size <= MAX_PAGE_SIZE:
+        raise endpoints.BadRequestException(
+            'page_size must be between 1 and {}'.format(MAX_PAGE_SIZE))
+    start_cursor = get_cursor(cursor)
+
+    @ndb.tasklet
+    def fetch():
+        results, next_cursor, more = yield query.fetch_page_async(
+            page_size, start_cursor=start_cursor, keys_only=keys_only)
+        raise ndb.Return(
+            (results, next_cursor.urlsafe() if more and next_cursor else None))
+    return fetch()
@@ -0,0 +1,278 @@
+"""words.py - The word dictionary hangman words are picked from. Words are
+grouped by length and difficulty, and a guess is applied with bit operations
+on the letters a word contains instead of rescanning and rebuilding
+strings.
+
+Letters are encoded as bits of a 26-bit mask, 'a' being bit 0. A game's
+guesses are one such mask, and the revealed word is derived from it with a
+single translate of the word.
+
+The dictionary is served from words.idx, a file of fixed-size records
+grouped by bucket, which is opened without parsing the word list and read a
+record at a time. Rebuild it after editing words.txt with:
+
+    python words.py [words file] [index file]
+"""
+
+import hashlib
+import os
+import random
+import string
+import struct
+import sys
+
+ALPHABET = string.ascii_lowercase
+LETTERS = dict((1 << i, letter) for i, letter in enumerate(ALPHABET))
+WORDS_FILE = os.path.join(os.path.dirname(__file__), 'words.txt')
+INDEX_FILE = os.path.join(os.path.dirname(__file__), 'words.idx')
+DIFFICULTIES = ('easy', 'medium', 'hard')
+# Translate tables of reveal, by mask of the letters they hide. Cleared when
+# it reaches REVEAL_TABLES entries, 256 bytes each.
+REVEAL_TABLES = 4096
+_reveal_tables = {}
+
+# Relative frequency of each letter in English text, 'a' to 'z'. Words made
+# of rare letters are harder to guess.
+LETTER_FREQUENCIES = (
+    8.2, 1.5, 2.8, 4.3, 12.7, 2.2, 2.0, 6.1, 7.0, 0.15, 0.77, 4.0, 2.4,
+    6.7, 7.5, 1.9, 0.095, 6.0, 6.3, 9.1, 2.8, 0.98, 2.4, 0.15, 2.0, 0.074)
+
+
+def letter_bit(letter):
+    """Returns the mask bit of a single lowercase letter"""
+    return 1 << (ord(letter) - 97)
+
+
+def letter_mask(letters):
+    """Returns the mask of all the letters in an iterable of letters"""
+    mask = 0
+    for letter in letters:
+        mask |= letter_bit(letter)
+    return mask
+
+
+def mask_letters(mask):
+    """Returns the letters of a mask in alphabetical order"""
+    letters = []
+    while mask:
+        bit = mask & -mask
+        letters.append(LETTERS[bit])
+        mask ^= bit
+    return ''.join(letters)
+
+
+def reveal(word, guessed, word_mask=None):
+    """Returns the lowercase word, a str, with the letters not yet guessed
+    replaced by '_'. word_mask is the word's letter_mask, if already
+    known."""
+    if word_mask is None:
+        word_mask = letter_mask(word)
+    hidden = word_mask & ~guessed
+    table = _reveal_tables.get(hidden)
+    if table is None:
+        if len(_reveal_tables) >= REVEAL_TABLES:
+            _reveal_tables.clear()
+        letters = mask_letters(hidden)
+        table = _reveal_tables[hidden] = string.maketrans(
+            letters, '_' * len(letters))
+    return word.translate(table)
+
+
+def is_solved(word_mask, guessed):
+    """True if every letter of the word with letter_mask word_mask has been
+    guessed"""
+    return word_mask & ~guessed == 0
+
+
+def difficulty_score(word):
+    """Returns how hard a word is to guess: long words with few repeated and
+    rare letters score highest"""
+    letters = set(word.lower())
+    rarity = sum(1.0 / LETTER_FREQUENCIES[ord(letter) - 97]
+                 for letter in letters)
+    return len(letters) + rarity
+
+
+class WordDictionary(object):
+    """Words indexed by length and difficulty. Each (length, difficulty)
+    bucket is a range of consecutive records, sorted by word, so choosing a
+    word costs one random pick over the buckets and one record read whatever
+    the size of the dictionary."""
+    # Random picks made to find a word the player has not seen before
+    # settling for a repeat
+    CHOOSE_TRIES = 5
+
+    def __init__(self, words):
+        words = set(word.strip().lower() for word in words
+                    if word.strip().isalpha() and
+                    all(letter in ALPHABET for letter in word.strip().lower()))
+        scores = sorted(difficulty_score(word) for word in words)
+        # Split the dictionary into thirds by difficulty score
+        self.thresholds = [scores[len(scores) * i / len(DIFFICULTIES)]
+                           for i in range(1, len(DIFFICULTIES))]
+        self.words = sorted(words, key=lambda word: (
+            len(word), DIFFICULTIES.index(self.difficulty(word)), word))
+        self.buckets = {}
+        for i, word in enumerate(self.words):
+            key = (len(word), self.difficulty(word))
+            start, count = self.buckets.get(key, (i, 0))
+            self.buckets[key] = (start, count + 1)
+
+    @classmethod
+    def load(cls, path=WORDS_FILE):
+        """Loads a dictionary with one word per line"""
+        with open(path) as words:
+            return cls(words)
+
+    def __len__(self):
+        return len(self.words)
+
+    def record(self, i):
+        """Returns the i-th word"""
+        return self.words[i]
+
+    def difficulty(self, word):
+        """Returns the difficulty bucket of a word"""
+        score = difficulty_score(word)
+        for difficulty, threshold in zip(DIFFICULTIES, self.thresholds):
+            if score < threshold:
+                return difficulty
+        return DIFFICULTIES[-1]
+
+    def choose(self, difficulty=None, length=None, seen=None):
+        """Returns a random word, optionally of the given difficulty and
+        length, avoiding the words of the WordFilter seen where it can.
+        Raises ValueError if no word matches."""
+        buckets = [bucket for (word_length, word_difficulty), bucket
+                   in self.buckets.iteritems()
+                   if difficulty in (None, word_difficulty) and
+                   length in (None, word_length)]
+        total = sum(count for _, count in buckets)
+        if not total:
+            raise ValueError('No word matches')
+        for _ in range(self.CHOOSE_TRIES):
+            choice = random.randrange(total)
+            for start, count in buckets:
+                if choice < count:
+                    word = self.record(start + choice)
+                    break
+                choice -= count
+            if seen is None or word not in seen:
+                break
+        return word
+
+    def write_index(self, path=INDEX_FILE):
+        """Writes the dictionary in the format WordIndex reads"""
+        record_size = max(len(word) for word in self.words)
+        buckets = sorted(self.buckets.items(),
+                         key=lambda (key, (start, count)): start)
+        with open(path, 'wb') as index:
+            index.write(struct.pack(
+                WordIndex.HEADER, WordIndex.MAGIC, record_size,
+                len(self.words), len(buckets), *self.thresholds))
+            for (length, difficulty), (start, count) in buckets:
+                index.write(struct.pack(WordIndex.BUCKET, length,
+                                        DIFFICULTIES.index(difficulty),
+                                        start, count))
+            for word in self.words:
+                index.write(word.ljust(record_size, '\0'))
+
+
+class WordIndex(WordDictionary):
+    """A WordDictionary read from the file written by write_index. Opening
+    it parses the header and bucket table only; records are sliced out of
+    a memory map of the file as they are needed, or, where the runtime
+    allows no memory map, out of a copy of the file read at open. Either
+    way record() keeps no file position, so threads can share the index."""
+    MAGIC = 'HWI1'
+    HEADER = '<4sIII' + 'd' * (len(DIFFICULTIES) - 1)
+    BUCKET = '<BBII'
+
+    def __init__(self, path=INDEX_FILE):
+        self._file = open(path, 'rb')
+        header = self._file.read(struct.calcsize(self.HEADER))
+        fields = struct.unpack(self.HEADER, header)
+        magic, self.record_size, self.size, bucket_count = fields[:4]
+        if magic != self.MAGIC:
+            raise ValueError('{} is not a word index'.format(path))
+        self.thresholds = list(fields[4:])
+        self.buckets = {}
+        bucket_size = struct.calcsize(self.BUCKET)
+        for _ in range(bucket_count):
+            length, difficulty, start, count = struct.unpack(
+                self.BUCKET, self._file.read(bucket_size))
+            self.buckets[(length, DIFFICULTIES[difficulty])] = (start, count)
+        self._records_offset = len(header) + bucket_count * bucket_size
+        try:
+            import mmap
+            self._data = mmap.mmap(self._file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        except (ImportError, EnvironmentError):
+            self._file.seek(0)
+            self._data = self._file.read()
+            self._file.close()
+
+    def __len__(self):
+        return self.size
+
+    def record(self, i):
+        offset = self._records_offset + i * self.record_size
+        return self._data[offset:offset + self.record_size].rstrip('\0')
+
+
+class WordFilter(object):
+    """Bloom filter of the words a player has been given, stored on the User
+    in a few hundred bytes. Membership may be a false positive, never a
+    false negative. Once CAPACITY words have been added it starts over, as
+    the false positive rate would otherwise climb."""
+    BITS = 2048
+    HASHES = 4
+    # About 1% false positives at capacity
+    CAPACITY = 200
+
+    def __init__(self, data=None):
+        if data:
+            self.count = struct.unpack('<H', data[:2])[0]
+            self.bits = bytearray(data[2:])
+        else:
+            self.count = 0
+            self.bits = bytearray(self.BITS / 8)
+
+    def _positions(self, word):
+        digest = hashlib.md5(word).digest()
+        return [struct.unpack('<H', digest[2 * i:2 * i + 2])[0] % self.BITS
+                for i in range(self.HASHES)]
+
+    def __contains__(self, word):
+        return all(self.bits[bit / 8] & (1 << bit % 8)
+                   for bit in self._positions(word))
+
+    def add(self, word):
+        if self.count >= self.CAPACITY:
+            self.__init__()
+        for bit in self._positions(word):
+            self.bits[bit / 8] |= 1 << bit % 8
+        self.count += 1
+
+    def to_bytes(self):
+        return struct.pack('<H', self.count) + str(self.bits)
+
+
+_dictionary = None
+
+
+def get_dictionary():
+    """Returns the dictionary, opening the index on first use, or loading
+    the word list if there is no index"""
+    global _dictionary
+    if _dictionary is None:
+        if os.path.exists(INDEX_FILE):
+            _dictionary = WordIndex()
+        else:
+            _dictionary = WordDictionary.load()
+    return _dictionary
+
+
+if __name__ == '__main__':
+    WordDictionary.load(sys.argv[1] if len(sys.argv) > 1 else WORDS_FILE)\
+        .write_index(sys.argv[2] if len(sys.argv) > 2 else INDEX_FILE)